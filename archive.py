@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from sensor_store import SensorSeries, SensorStore
+
+MAGIC = b'SENSARC1'
+ALIGNMENT = 64
+# values that mark a missing reading in the integer columns
+MISSING_COUNT = np.iinfo(np.uint16).max
+MISSING_RSSI = np.iinfo(np.int16).min
+COLUMNS = (
+    ('timestamps', '<i8'),
+    ('counts', '<u2'),
+    ('rssi', '<i2'),
+    ('snr', '<f4'),
+)
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def encode_sensor(data):
+    """
+    input: DataFrame with Date and Count, optionally RSSI and SNR
+    output: dict with the four archive columns of the sensor, sorted on time
+    """
+    data = data.dropna(subset=['Date']).sort_values('Date', kind='stable')
+    rows = len(data)
+
+    counts = data['Count'].to_numpy(dtype=float)
+    valid = ~np.isnan(counts)
+    if np.any(counts[valid] != np.round(counts[valid])) or np.any(
+            (counts[valid] < 0) | (counts[valid] >= MISSING_COUNT)):
+        raise ValueError('Counts must be whole numbers between 0 and '
+                         f'{MISSING_COUNT - 1} to fit in the archive')
+
+    if 'RSSI' in data.columns:
+        rssi = data['RSSI'].to_numpy(dtype=float)
+        rssi = np.where(np.isnan(rssi), MISSING_RSSI, rssi)
+    else:
+        rssi = np.full(rows, MISSING_RSSI)
+    snr = data['SNR'].to_numpy(dtype=float) if 'SNR' in data.columns else \
+        np.full(rows, np.nan)
+
+    return {
+        'timestamps': data['Date'].to_numpy(dtype='datetime64[ns]').view(
+            np.int64),
+        'counts': np.where(valid, counts, MISSING_COUNT),
+        'rssi': rssi,
+        'snr': snr,
+    }
+
+
+def write_archive(path, sensors):
+    """
+    input: path of the archive and a dict of sensor name -> DataFrame
+
+    All sensors are stored in one file: a JSON header with the sensor
+    directory, followed by one contiguous column per field. Every column is
+    aligned to 64 bytes so it can be memory-mapped directly.
+    """
+    encoded = {name: encode_sensor(data) for name, data in sensors.items()}
+
+    directory = []
+    start = 0
+    for name, columns in encoded.items():
+        rows = len(columns['timestamps'])
+        directory.append({'name': name, 'start': start, 'rows': rows})
+        start += rows
+    total_rows = start
+
+    # the header size depends on the column offsets, so leave room for it
+    header = {'rows': total_rows, 'sensors': directory, 'columns': {}}
+    header_size = len(json.dumps(header)) + 256 * len(COLUMNS)
+    offset = align(len(MAGIC) + 8 + header_size)
+    for column, dtype in COLUMNS:
+        header['columns'][column] = {'dtype': dtype, 'offset': offset}
+        offset = align(offset + total_rows * np.dtype(dtype).itemsize)
+    header_bytes = json.dumps(header).encode()
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for column, dtype in COLUMNS:
+            f.seek(header['columns'][column]['offset'])
+            for name in encoded:
+                f.write(encoded[name][column].astype(dtype).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+def load_export(file_path):
+    """
+    input: path of a raw export or a cleaned file
+    output: DataFrame with Date, Count and, when present, RSSI and SNR
+    """
+    import openpyxl
+
+    from file_cache import read_excel_cached
+    from streaming import find_header
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        skiprows, _ = find_header(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+    return read_excel_cached(file_path, skiprows=skiprows or None)
+
+
+def archive_name(file_path, sensors):
+    """
+    input: path of a sensor export and the sensors already in the archive
+    output: name to store the sensor under, None when it is taken
+
+    The same sensor shows up in several data sets (12juni/2.B53.xlsx and
+    Data/TriggerCounts/.../2.B53.xlsx), the later one is stored with its
+    directory as prefix, like 12juni_2.B53.
+    """
+    from parallel import sensor_name
+
+    name = sensor_name(file_path)
+    if name not in sensors:
+        return name
+    directory = os.path.basename(os.path.dirname(os.path.abspath(file_path)))
+    name = f'{directory}_{name}'
+    return None if name in sensors else name
+
+
+def convert_xlsx(file_paths, path):
+    """
+    input: list of xlsx files (Data/TriggerCounts, Data_clean, 12juni) and the
+    path of the archive to write
+    output: the written SensorArchive
+
+    The rows are stored as exported, the opening hours filter of
+    model.preprocess is applied when the data is analysed. Files that can't
+    be read (no Date/Count header, not an xlsx file) are logged and skipped,
+    see archive_name for sensors that are in several files.
+    """
+    from parallel import sensor_name
+
+    sensors = {}
+    for file_path in file_paths:
+        name = archive_name(file_path, sensors)
+        if name is None:
+            logging.warning(f'{file_path}: skipped, its sensor is already in '
+                            'the archive')
+            continue
+        try:
+            sensors[name] = load_export(file_path)
+        except Exception as error:
+            logging.warning(f'{file_path}: skipped, {error}')
+            continue
+        if name != sensor_name(file_path):
+            logging.warning(f'{file_path}: stored as {name}, its sensor is '
+                            'already in the archive')
+    write_archive(path, sensors)
+    return SensorArchive(path)
+
+
+class SensorArchive:
+    """
+    Read-only view on an archive file. The columns are np.memmap arrays, so
+    opening costs almost nothing and processes reading the same archive share
+    the page cache.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a sensor archive')
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(f.read(header_size))
+        self.path = path
+        self.directory = {sensor['name']: sensor
+                          for sensor in self.header['sensors']}
+        rows = self.header['rows']
+        self.columns = {}
+        for column, info in self.header['columns'].items():
+            if rows == 0:
+                self.columns[column] = np.zeros(0, dtype=info['dtype'])
+                continue
+            self.columns[column] = np.memmap(path, dtype=info['dtype'],
+                                             mode='r', offset=info['offset'],
+                                             shape=(rows,))
+
+    def sensors(self):
+        return list(self.directory)
+
+    def column(self, sensor, column):
+        """
+        output: memmap slice of one column of a sensor, no data is read yet
+        """
+        info = self.directory[sensor]
+        return self.columns[column][info['start']:info['start'] + info['rows']]
+
+    def timestamps(self, sensor):
+        return self.column(sensor, 'timestamps').view('datetime64[ns]')
+
+    def counts(self, sensor):
+        """
+        output: counts as float64 with NaN for missing readings
+        """
+        counts = self.column(sensor, 'counts')
+        return np.where(counts == MISSING_COUNT, np.nan, counts)
+
+    def frame(self, sensor):
+        """
+        output: DataFrame with Date, Count, RSSI and SNR of a sensor
+        """
+        rssi = self.column(sensor, 'rssi')
+        return pd.DataFrame({
+            'Date': self.timestamps(sensor),
+            'Count': self.counts(sensor),
+            'RSSI': np.where(rssi == MISSING_RSSI, np.nan, rssi),
+            'SNR': np.asarray(self.column(sensor, 'snr'), dtype=float),
+        })
+
+    def series(self, sensor):
+        """
+        output: SensorSeries of a sensor, the timestamps stay memory-mapped
+        """
+        return SensorSeries(self.timestamps(sensor), self.counts(sensor),
+                            sort=False)
+
+    def to_store(self):
+        store = SensorStore()
+        for sensor in self.directory:
+            store.series[sensor] = self.series(sensor)
+        return store
+
+
+if __name__ == '__main__':
+    # python archive.py sensors.sarc Data/TriggerCounts/Alta_sensors/*.xlsx
+    archive = convert_xlsx(sys.argv[2:], sys.argv[1])
+    print(f'{archive.header["rows"]} rows of {len(archive.sensors())} sensors '
+          f'written to {sys.argv[1]}')
@@ -0,0 +1,253 @@
+"""
+Headless batch processing of whole sensor directories.
+
+Runs preprocess, segmentation and classification for every sensor file and
+every day, and writes one session table per file as soon as it is done:
+
+    python batch.py 12juni/ Data_clean/Locus_sensors/ --output batch_output
+    python batch.py 12juni/ --format parquet --workers 8 --plots
+
+The tables go to <output>/<input directory>/<file name>.csv (or .parquet),
+with plots in <output>/<input directory>/<file name>/<date>.png. With
+--recursive the subdirectories below the input directory are kept. A manifest
+in the output directory remembers the hash of every processed file and the
+settings, unchanged files are skipped on the next run. matplotlib is only
+imported with --plots.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import as_completed
+
+import pandas as pd
+
+from file_cache import file_hash
+from segmentation import default_params
+
+EXTENSIONS = ('.xlsx', '.xls')
+FORMATS = ('csv', 'parquet')
+MANIFEST = 'manifest.json'
+
+
+def find_files(paths, recursive=False):
+    """
+    input: list of directories and files
+    output: list of (sensor file, input directory it was found in) pairs,
+    sorted per directory, the directory is None for a file given directly
+    """
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append((path, None))
+            continue
+        if recursive:
+            found = [os.path.join(root, name)
+                     for root, _, names in os.walk(path) for name in names]
+        else:
+            found = [os.path.join(path, name) for name in os.listdir(path)]
+        files += sorted((name, path) for name in found
+                        if name.lower().endswith(EXTENSIONS) and
+                        not os.path.basename(name).startswith('~$'))
+    return files
+
+
+def output_name(file_path, input_dir=None):
+    """
+    input: a sensor file and the input directory it was found in
+    output: path of the table of a file relative to the output directory,
+    <input directory>/<path below it> without the extension, so files with
+    the same name in different subdirectories of --recursive don't overwrite
+    each other. A file given directly uses its own directory.
+    """
+    if input_dir is None:
+        input_dir = os.path.dirname(os.path.abspath(file_path))
+    input_dir = os.path.abspath(input_dir)
+    relative = os.path.relpath(os.path.abspath(file_path), input_dir)
+    return os.path.join(os.path.basename(input_dir),
+                        os.path.splitext(relative)[0])
+
+
+def write_table(table, path, fmt):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if fmt == 'parquet':
+        table.to_parquet(tmp_path, index=False)
+    else:
+        table.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def process_sensor_file(file_path, table_path, fmt='csv',
+                        occupancy_mode='Exact', plot_dir=None):
+    """
+    Work unit of the batch: all days of one sensor file.
+    output: dict with the number of days and sessions and the seconds it
+    took, the table is written to table_path and the plots (only with a
+    plot_dir) next to it
+    """
+    from model import predict_occupancy_session
+    from parallel import load_sensor_file, sensor_name
+
+    start = time.perf_counter()
+    data = load_sensor_file(file_path)
+    sensor = sensor_name(file_path)
+    tables = []
+    days = data['Date'].dt.normalize()
+    for day, day_data in data.groupby(days, sort=False):
+        img, session_stats = predict_occupancy_session(
+            day_data, str(day.date()), occupancy_mode,
+            render=plot_dir is not None)
+        if img is not None:
+            os.makedirs(plot_dir, exist_ok=True)
+            with open(os.path.join(plot_dir, f'{day.date()}.png'), 'wb') as f:
+                f.write(img)
+        session_stats.insert(0, 'Date', day.date())
+        session_stats.insert(0, 'Sensor', sensor)
+        tables.append(session_stats)
+
+    table = pd.concat(tables, ignore_index=True) if tables else \
+        pd.DataFrame(columns=['Sensor', 'Date'])
+    write_table(table, table_path, fmt)
+    return {'days': len(tables), 'sessions': len(table),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+class Manifest:
+    """
+    The hash and settings of every processed file, saved after every file so
+    an interrupted run continues where it stopped.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def unchanged(self, file_path, digest, settings, table_path):
+        entry = self.entries.get(os.path.abspath(file_path))
+        return (entry is not None and entry['hash'] == digest and
+                entry['settings'] == settings and
+                os.path.exists(table_path))
+
+    def record(self, file_path, digest, settings, table_path, result):
+        self.entries[os.path.abspath(file_path)] = dict(
+            hash=digest, settings=settings, table=table_path, **result)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def run_batch(paths, output_dir, fmt='csv', occupancy_mode='Exact',
+              workers=None, plots=False, force=False, recursive=False,
+              log=print):
+    """
+    input: directories and files, the output directory and the options of
+    the command line
+    output: dict with the lists of processed, unchanged and failed files
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'format should be one of {", ".join(FORMATS)}')
+    settings = dict(default_params(), occupancy_mode=occupancy_mode,
+                    format=fmt, plots=plots)
+    manifest = Manifest(output_dir)
+    files = find_files(paths, recursive)
+    report = {'processed': [], 'unchanged': [], 'failed': []}
+
+    tasks = []
+    for file_path, input_dir in files:
+        name = output_name(file_path, input_dir)
+        table_path = os.path.join(output_dir, f'{name}.{fmt}')
+        digest = file_hash(file_path)
+        if not force and manifest.unchanged(file_path, digest, settings,
+                                            table_path):
+            report['unchanged'].append(file_path)
+            continue
+        plot_dir = os.path.join(output_dir, name) if plots else None
+        tasks.append((file_path, digest, table_path, plot_dir))
+    log(f'{len(files)} files, {len(report["unchanged"])} unchanged, '
+        f'{len(tasks)} to process')
+
+    def finished(task, result):
+        file_path, digest, table_path, _ = task
+        manifest.record(file_path, digest, settings, table_path, result)
+        report['processed'].append(file_path)
+        log(f'{file_path}: {result["days"]} days, {result["sessions"]} '
+            f'sessions ({result["seconds"]:.1f} s)')
+
+    def failed(task, error):
+        report['failed'].append(task[0])
+        log(f'{task[0]}: skipped, {error}')
+
+    # a file that can't be read is reported, the others are still processed
+    if workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            try:
+                result = process_sensor_file(task[0], task[2], fmt,
+                                             occupancy_mode, task[3])
+            except Exception as error:
+                failed(task, error)
+                continue
+            finished(task, result)
+        return report
+
+    from parallel import make_pool
+
+    with make_pool(workers) as pool:
+        futures = {pool.submit(process_sensor_file, task[0], task[2], fmt,
+                               occupancy_mode, task[3]): task
+                   for task in tasks}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                failed(futures[future], error)
+                continue
+            finished(futures[future], result)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('paths', nargs='+',
+                        help='sensor directories or files')
+    parser.add_argument('--output', default='batch_output')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--occupancy-mode', choices=['Exact', 'Grouped'],
+                        default='Exact')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes, all cores by default')
+    parser.add_argument('--plots', action='store_true',
+                        help='also save a plot of every day')
+    parser.add_argument('--force', action='store_true',
+                        help='process unchanged files again')
+    parser.add_argument('--recursive', action='store_true')
+    args = parser.parse_args()
+
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    if missing:
+        parser.error(f'not found: {", ".join(missing)}')
+    if args.format == 'parquet' and not any(
+            importlib.util.find_spec(engine)
+            for engine in ('pyarrow', 'fastparquet')):
+        parser.error('parquet output needs pyarrow (pip install pyarrow), '
+                     'or use --format csv')
+
+    start = time.perf_counter()
+    report = run_batch(args.paths, args.output, args.format,
+                       args.occupancy_mode, args.workers, args.plots,
+                       args.force, args.recursive)
+    print(f'{len(report["processed"])} processed, '
+          f'{len(report["unchanged"])} unchanged, {len(report["failed"])} '
+          f'failed in {time.perf_counter() - start:.1f} s')
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
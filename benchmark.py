@@ -0,0 +1,365 @@
+"""
+Benchmarks of the occupancy pipeline.
+
+Times every stage (parse, segment, split, classify, stats, render, csv, ...)
+on synthetic 5-minute exports and on the real files in uploads/ and
+Data_clean/, and saves rows/s and peak memory per stage as JSON:
+
+    python benchmark.py --days 60 --sensors 4 --density 6 --output new.json
+    python benchmark.py --no-real --no-render
+    python benchmark.py --compare old.json new.json
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+STAGES = ('parse', 'parse_cached', 'segment', 'split', 'classify', 'stats',
+          'peaks', 'render', 'csv', 'upload')
+# (pattern, raw export), /upload only accepts the raw exports
+REAL_FILES = (
+    ('uploads/*.xlsx', True),
+    ('Data_clean/*_sensors/*.xlsx', False),
+)
+# IQR averages of the training data of the k-NN model, per occupancy
+SESSION_LEVELS = (61.5, 119.0, 214.7, 244.9)
+
+
+def synthetic_counts(days=30, session_density=4.0, seed=0,
+                     start='2024-05-01'):
+    """
+    input: number of days, average number of sessions per day and a seed
+    output: DataFrame like a raw export (Date, Count, RSSI, SNR), one reading
+    every 5 minutes, with sessions at the count levels of the model and some
+    missing counts
+    """
+    rng = np.random.default_rng(seed)
+    per_day = 24 * 12
+    dates = pd.date_range(start, periods=days * per_day, freq='5min')
+    counts = np.where(rng.random(len(dates)) < 0.05,
+                      rng.integers(1, 4, len(dates)), 0).astype(float)
+
+    for day in range(days):
+        for _ in range(rng.poisson(session_density)):
+            # sessions start during opening hours (8-24)
+            first = day * per_day + rng.integers(8 * 12, per_day - 6)
+            length = rng.integers(6, 48)
+            level = rng.choice(SESSION_LEVELS)
+            last = min(first + length, (day + 1) * per_day)
+            counts[first:last] = np.maximum(
+                rng.normal(level, level * 0.3, last - first).round(), 5)
+            if last < (day + 1) * per_day:
+                counts[last] = 0
+
+    counts[rng.random(len(dates)) < 0.01] = np.nan
+    return pd.DataFrame({
+        'Date': dates,
+        'Count': counts,
+        'RSSI': rng.integers(-110, -60, len(dates)),
+        'SNR': rng.normal(8, 2, len(dates)).round(1),
+    })
+
+
+def write_export(data, file_path):
+    """
+    Writes the data like the sensor exports: two lines above the header
+    """
+    data.to_excel(file_path, startrow=2, index=False)
+
+
+class StageTimer:
+    """
+    Collects the time, number of rows and peak memory of every stage. Peak
+    memory is only measured when tracemalloc is running.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, rows):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        result = self.stages.setdefault(name, {'seconds': 0.0, 'rows': 0,
+                                               'peak_bytes': None})
+        result['seconds'] += seconds
+        result['rows'] += rows
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1] - before
+            result['peak_bytes'] = max(result['peak_bytes'] or 0, peak)
+
+    def report(self):
+        report = {}
+        for name in STAGES:
+            if name not in self.stages:
+                continue
+            result = dict(self.stages[name])
+            result['seconds'] = round(result['seconds'], 6)
+            result['rows_per_second'] = round(
+                result['rows'] / result['seconds']) if result['seconds'] \
+                else None
+            report[name] = result
+        return report
+
+
+def upload_file(client, file_path):
+    """
+    Posts a file to /upload in the "process all dates" mode and waits for
+    the job
+    """
+    with open(file_path, 'rb') as f:
+        response = client.post('/upload', data={
+            'file': (f, os.path.basename(file_path)),
+            'occupancy_mode': 'Exact', 'no_date': 'on'},
+            content_type='multipart/form-data')
+    job_id = response.location.rstrip('/').split('/')[-1]
+    while True:
+        status = client.get(f'/jobs/{job_id}/status').get_json()
+        if status['status'] in ('done', 'failed'):
+            return status
+        time.sleep(0.01)
+
+
+def run_file(file_path, timer, stages, cache_dir, client=None):
+    """
+    Runs all stages on one export file, output: number of rows and days
+    """
+    from model import (calculate_session_stats, find_nearest_occupancies,
+                       segmented_stats_table)
+    from parallel import load_sensor_file
+    from segmentation import (filter_short_sessions, label_sessions,
+                              split_sessions_on_changes)
+    from useful_functions import make_sessions
+
+    raw_rows = len(pd.read_excel(file_path, usecols=[0]))
+    with timer.stage('parse', raw_rows):
+        data = load_sensor_file(file_path, cache_dir=cache_dir)
+    with timer.stage('parse_cached', raw_rows):
+        data = load_sensor_file(file_path, cache_dir=cache_dir)
+
+    data = data.sort_values('Date', kind='stable').reset_index(drop=True)
+    days = [(day.date(), day_data.reset_index(drop=True)) for day, day_data
+            in data.groupby(data['Date'].dt.normalize(), sort=False)]
+
+    tables = []
+    for date, day_data in days:
+        rows = len(day_data)
+        counts = day_data['Count'].to_numpy()
+        with timer.stage('segment', rows):
+            labels = filter_short_sessions(label_sessions(counts))
+        with timer.stage('split', rows):
+            labels = filter_short_sessions(
+                split_sessions_on_changes(counts, labels))
+        day_data = day_data.assign(Session=labels)
+        with timer.stage('classify', rows):
+            session_avgs = segmented_stats_table(day_data)[
+                'IQR_Mean'].sort_index()
+            session_people = dict(zip(session_avgs.index,
+                                      find_nearest_occupancies(session_avgs)))
+        with timer.stage('stats', rows):
+            stats = pd.DataFrame(calculate_session_stats(
+                day_data, session_avgs, session_people))
+        if 'peaks' in stages:
+            with timer.stage('peaks', rows):
+                make_sessions(data, date, 0, 1)
+        if 'render' in stages:
+            from render import plot_day
+            with timer.stage('render', rows):
+                plot_day(day_data, date, 'Exact', session_avgs,
+                         session_people)
+        stats.insert(0, 'Date', date)
+        tables.append(stats)
+
+    if 'csv' in stages and tables:
+        with timer.stage('csv', len(data)):
+            pd.concat(tables, ignore_index=True).to_csv(io.StringIO(),
+                                                        index=False)
+    if client is not None:
+        with timer.stage('upload', len(data)):
+            upload_file(client, file_path)
+    return len(data), len(days)
+
+
+def run_dataset(name, file_paths, stages, measure_memory, client=None):
+    """
+    output: the report of one dataset, timed without tracemalloc and, with
+    measure_memory, run a second time for the peak memory
+    """
+    from model import get_classifier
+
+    # the k-NN model is loaded once per process, not part of any stage
+    get_classifier()
+
+    skipped = set()
+
+    def run(memory):
+        timer = StageTimer()
+        rows = days = 0
+        with tempfile.TemporaryDirectory() as cache_dir:
+            if memory:
+                tracemalloc.start()
+            try:
+                for file_path in file_paths:
+                    try:
+                        file_rows, file_days = run_file(
+                            file_path, timer, stages, cache_dir,
+                            client if not memory else None)
+                    except ValueError as error:
+                        # some files in Data_clean are not sensor exports
+                        if file_path not in skipped:
+                            print(f'  skipped {file_path}: {error}')
+                        skipped.add(file_path)
+                        continue
+                    rows += file_rows
+                    days += file_days
+            finally:
+                if memory:
+                    tracemalloc.stop()
+        return rows, days, timer.report()
+
+    rows, days, report = run(False)
+    if measure_memory:
+        _, _, memory = run(True)
+        for stage, result in report.items():
+            result['peak_bytes'] = memory.get(stage, {}).get('peak_bytes')
+    print(f'{name}: {len(file_paths)} files, {rows} rows, {days} days')
+    for stage, result in report.items():
+        peak = result['peak_bytes']
+        peak = f'{peak / 1e6:8.1f} MB' if peak is not None else ''
+        print(f'  {stage:<13}{result["seconds"]:9.3f} s '
+              f'{result["rows_per_second"] or 0:>12,} rows/s {peak}')
+    return {'files': [file_path for file_path in file_paths
+                      if file_path not in skipped],
+            'skipped': sorted(skipped), 'rows': rows, 'days': days,
+            'stages': report}
+
+
+def totals(datasets):
+    result = {}
+    for dataset in datasets.values():
+        for stage, stage_result in dataset['stages'].items():
+            total = result.setdefault(stage, {'seconds': 0.0, 'rows': 0})
+            total['seconds'] += stage_result['seconds']
+            total['rows'] += stage_result['rows']
+    for total in result.values():
+        total['seconds'] = round(total['seconds'], 6)
+        total['rows_per_second'] = round(total['rows'] / total['seconds']) \
+            if total['seconds'] else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """
+    Prints the total time of every stage in two benchmark files
+    """
+    with open(old_path) as f:
+        old = json.load(f)['totals']
+    with open(new_path) as f:
+        new = json.load(f)['totals']
+    print(f'{"stage":<13}{"old s":>10}{"new s":>10}{"speedup":>9}')
+    for stage in STAGES:
+        if stage not in old or stage not in new:
+            continue
+        old_seconds = old[stage]['seconds']
+        new_seconds = new[stage]['seconds']
+        speedup = old_seconds / new_seconds if new_seconds else float('inf')
+        print(f'{stage:<13}{old_seconds:10.3f}{new_seconds:10.3f}'
+              f'{speedup:8.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--sensors', type=int, default=2)
+    parser.add_argument('--density', type=float, default=4.0,
+                        help='average number of sessions per day')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-real', action='store_true',
+                        help='skip the files in uploads/ and Data_clean/')
+    parser.add_argument('--no-render', action='store_true')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc run')
+    parser.add_argument('--upload', action='store_true',
+                        help='also time the /upload route end to end')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    warnings.filterwarnings('ignore')
+    stages = set(STAGES)
+    if args.no_render:
+        stages.discard('render')
+    client = None
+    if args.upload:
+        import interface
+        interface.app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+        client = interface.app.test_client()
+
+    datasets = {}
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic = []
+        for sensor in range(args.sensors):
+            file_path = os.path.join(directory, f'synthetic_{sensor}.xlsx')
+            write_export(synthetic_counts(args.days, args.density,
+                                          args.seed + sensor), file_path)
+            synthetic.append(file_path)
+        if synthetic:
+            datasets['synthetic'] = run_dataset(
+                'synthetic', synthetic, stages, not args.no_memory, client)
+
+        if not args.no_real:
+            for pattern, raw_export in REAL_FILES:
+                file_paths = sorted(glob.glob(pattern))
+                if file_paths:
+                    datasets[pattern] = run_dataset(
+                        pattern, file_paths, stages, not args.no_memory,
+                        client if raw_export else None)
+
+    result = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'args': vars(args),
+        'datasets': datasets,
+        'totals': totals(datasets),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'saved to {args.output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
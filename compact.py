@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+MINUTES_PER_DAY = 24 * 60
+SECONDS_PER_MINUTE = 60
+MAX_COUNT = np.iinfo(np.uint16).max
+
+
+class CompactFrame:
+    """
+    Date/Count readings in a small footprint: timestamps as int32 minutes
+    since 1970 plus a uint8 seconds offset, counts as uint16 with a validity
+    mask instead of NaN and session ids as int32. That is 8 bytes per row (12
+    with sessions) instead of the 16 (24) of a Date/Count(/Session)
+    DataFrame.
+
+    Timestamps keep their whole seconds, so Start, End and Duration of the
+    session stats are the same as with a DataFrame, only fractions of
+    seconds are dropped. Slices of a frame are views, so splitting it into
+    days doesn't copy any data.
+    """
+
+    def __init__(self, minutes, seconds, counts, valid, sessions=None):
+        self.minutes = minutes
+        self.seconds = seconds
+        self.counts = counts
+        self.valid = valid
+        self.sessions = sessions
+
+    @classmethod
+    def from_arrays(cls, dates, counts):
+        """
+        input: datetime64 array and float array with NaN for missing counts
+        output: CompactFrame sorted on time
+        """
+        dates = np.asarray(dates, dtype='datetime64[s]')
+        counts = np.asarray(counts, dtype=float)
+        valid = ~np.isnan(counts)
+        if np.any(counts[valid] != np.round(counts[valid])) or np.any(
+                (counts[valid] < 0) | (counts[valid] > MAX_COUNT)):
+            raise ValueError('Counts must be whole numbers between 0 and '
+                             f'{MAX_COUNT} for a compact frame')
+        seconds = dates.astype(np.int64)
+        if len(seconds) and np.any(seconds[1:] < seconds[:-1]):
+            order = np.argsort(seconds, kind='stable')
+            seconds = seconds[order]
+            counts, valid = counts[order], valid[order]
+        minutes, seconds = np.divmod(seconds, SECONDS_PER_MINUTE)
+        return cls(minutes.astype(np.int32), seconds.astype(np.uint8),
+                   np.where(valid, counts, 0).astype(np.uint16), valid)
+
+    @classmethod
+    def from_frame(cls, data):
+        """
+        input: DataFrame with Date and Count columns
+        output: CompactFrame without rows that have no Date
+        """
+        data = data.dropna(subset=['Date'])
+        return cls.from_arrays(data['Date'].to_numpy(),
+                               data['Count'].to_numpy())
+
+    def __len__(self):
+        return len(self.minutes)
+
+    @property
+    def empty(self):
+        return len(self.minutes) == 0
+
+    @property
+    def nbytes(self):
+        arrays = [self.minutes, self.seconds, self.counts, self.valid]
+        if self.sessions is not None:
+            arrays.append(self.sessions)
+        return sum(array.nbytes for array in arrays)
+
+    def dates(self):
+        seconds = self.minutes.astype(np.int64) * SECONDS_PER_MINUTE + \
+            self.seconds
+        return seconds.astype('datetime64[s]').astype('datetime64[ns]')
+
+    def count_values(self):
+        """
+        output: the counts as float64 with NaN for missing counts, only meant
+        for short stretches like a day
+        """
+        return np.where(self.valid, self.counts, np.nan)
+
+    def slice(self, first, last):
+        sessions = None if self.sessions is None else self.sessions[first:last]
+        return CompactFrame(self.minutes[first:last],
+                            self.seconds[first:last], self.counts[first:last],
+                            self.valid[first:last], sessions)
+
+    def select(self, mask):
+        sessions = None if self.sessions is None else self.sessions[mask]
+        return CompactFrame(self.minutes[mask], self.seconds[mask],
+                            self.counts[mask], self.valid[mask], sessions)
+
+    def window(self, start, end, closed='left'):
+        """
+        input: start and end time, closed is 'left' for [start, end) and
+        'both' for [start, end]
+        output: view with the readings in the window
+        """
+        first = self.position(start, 'left')
+        last = self.position(end, 'right' if closed == 'both' else 'left')
+        return self.slice(first, max(first, last))
+
+    def position(self, time, side):
+        """
+        output: the row where time would be inserted, like np.searchsorted on
+        the timestamps: first the minute, then the seconds within it
+        """
+        minute, second = divmod(to_seconds(time), SECONDS_PER_MINUTE)
+        low = np.searchsorted(self.minutes, minute, side='left')
+        high = np.searchsorted(self.minutes, minute, side='right')
+        return low + int(np.searchsorted(self.seconds[low:high], second,
+                                         side=side))
+
+    def day(self, date):
+        start = pd.Timestamp(date).normalize()
+        return self.window(start, start + pd.Timedelta(days=1))
+
+    def days(self):
+        """
+        output: (date, view) pairs for every day in the frame
+        """
+        days = self.minutes // MINUTES_PER_DAY
+        change = np.flatnonzero(days[1:] != days[:-1]) + 1
+        starts = np.concatenate(([0], change)) if len(days) else change
+        ends = np.concatenate((change, [len(days)]))
+        for first, last in zip(starts, ends):
+            date = np.datetime64(int(days[first]), 'D').astype(object)
+            yield date, self.slice(first, last)
+
+    def day_count(self):
+        """
+        output: the number of pairs days() gives
+        """
+        days = self.minutes // MINUTES_PER_DAY
+        if len(days) == 0:
+            return 0
+        return 1 + int(np.count_nonzero(days[1:] != days[:-1]))
+
+    def to_frame(self):
+        """
+        output: DataFrame with Date and Count (and Session) columns
+        """
+        data = pd.DataFrame({'Date': self.dates(),
+                             'Count': self.count_values()})
+        if self.sessions is not None:
+            data['Session'] = self.sessions.astype(np.int64)
+        return data
+
+
+def to_seconds(value):
+    return int(np.datetime64(pd.Timestamp(value), 's').astype(np.int64))
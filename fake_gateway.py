@@ -0,0 +1,112 @@
+"""
+Fake sensor gateway for load testing the /ingest endpoint.
+
+Sends batches of readings of many fake sensors, 5 minutes apart like the real
+sensors, and prints the ingest throughput:
+
+    python fake_gateway.py --url http://127.0.0.1:5000/ingest --sensors 500
+    python fake_gateway.py --in-process --format csv
+"""
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+def make_batches(sensors, batch_size, batches, seed=0):
+    """
+    output: list of batches, every batch a list of reading dicts
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime(2024, 5, 1, 8)
+    names = [f'fake.{index:04d}' for index in range(sensors)]
+    result = []
+    reading = 0
+    for _ in range(batches):
+        batch = []
+        for _ in range(batch_size):
+            sensor = names[reading % sensors]
+            step = reading // sensors
+            batch.append({
+                'sensor': sensor,
+                'time': (start + timedelta(minutes=5 * step)).isoformat(),
+                'count': int(rng.poisson(40) if rng.random() < 0.4 else 0),
+                'rssi': int(rng.integers(-110, -60)),
+                'snr': round(float(rng.normal(8, 2)), 1),
+            })
+            reading += 1
+        result.append(batch)
+    return result
+
+
+def encode(batch, fmt):
+    """
+    output: (body, content type) of a batch
+    """
+    if fmt == 'csv':
+        lines = ['sensor,time,count,rssi,snr']
+        lines += [f"{row['sensor']},{row['time']},{row['count']},"
+                  f"{row['rssi']},{row['snr']}" for row in batch]
+        return '\n'.join(lines).encode(), 'text/csv'
+    return json.dumps({'readings': batch}).encode(), 'application/json'
+
+
+def http_sender(url):
+    def send(body, content_type):
+        request = urllib.request.Request(
+            url, data=body, headers={'Content-Type': content_type})
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    return send
+
+
+def test_client_sender():
+    from interface import app
+
+    client = app.test_client()
+
+    def send(body, content_type):
+        return client.post('/ingest', data=body,
+                           content_type=content_type).status_code
+    return send
+
+
+def run(send, batches, fmt, threads):
+    """
+    output: dict with the number of readings, seconds and readings/s
+    """
+    bodies = [encode(batch, fmt) for batch in batches]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        statuses = list(pool.map(lambda body: send(*body), bodies))
+    seconds = time.perf_counter() - start
+    readings = sum(len(batch) for batch in batches)
+    failed = sum(status != 202 for status in statuses)
+    return {'readings': readings, 'requests': len(bodies), 'failed': failed,
+            'seconds': round(seconds, 3),
+            'readings_per_second': round(readings / seconds)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', default='http://127.0.0.1:5000/ingest')
+    parser.add_argument('--in-process', action='store_true',
+                        help='use the Flask test client instead of http')
+    parser.add_argument('--sensors', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--batches', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--format', choices=['json', 'csv'], default='json')
+    args = parser.parse_args()
+
+    send = test_client_sender() if args.in_process else http_sender(args.url)
+    batches = make_batches(args.sensors, args.batch_size, args.batches)
+    print(run(send, batches, args.format, args.threads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import count, stage
+
+# parsed exports are stored next to the code, so every loader shares them
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache',
+                         'sensor_exports')
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+SENSOR_COLUMNS = ('Date', 'Count', 'RSSI', 'SNR')
+
+
+def file_hash(file_path):
+    """
+    input: path of a file
+    output: sha1 hex digest of the file contents
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f'{key}.npz')
+
+
+def clean_columns(data, columns=SENSOR_COLUMNS):
+    """
+    input: raw DataFrame of a sensor export
+    output: DataFrame with only the sensor columns, Date as datetime and the
+    others numeric (unparseable values become NaT/NaN)
+    """
+    data = data[[column for column in columns if column in data.columns]]
+    cleaned = {}
+    for column in data.columns:
+        if column == 'Date':
+            cleaned[column] = pd.to_datetime(data[column], errors='coerce')
+        else:
+            cleaned[column] = pd.to_numeric(data[column], errors='coerce')
+    return pd.DataFrame(cleaned, index=data.index)
+
+
+def save_frame(data, path):
+    """
+    Stores the columns of the frame as a .npz file, written to a temporary file
+    first so other workers never read a half written cache entry.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **{column: data[column].to_numpy()
+                       for column in data.columns})
+    os.replace(tmp_path, path)
+
+
+def load_frame(path):
+    with np.load(path, allow_pickle=False) as arrays:
+        return pd.DataFrame({column: arrays[column]
+                             for column in arrays.files})
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, suffix='.npz'):
+    """
+    Removes the least recently used cache entries (files ending in suffix,
+    or one of a tuple of suffixes) until the cache is smaller than max_bytes.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(suffix):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def read_excel_cached(file_path, skiprows=None, columns=SENSOR_COLUMNS,
+                      cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    input: path of an excel export and the rows to skip before the header
+    output: DataFrame with the cleaned sensor columns of the export
+
+    The parsed columns are cached on disk, keyed by the hash of the file
+    contents. A changed file gets a new key, old entries are evicted when the
+    cache grows over max_bytes.
+    """
+    key = hashlib.sha1(
+        f'{file_hash(file_path)}:{skiprows}:{",".join(columns)}'.encode()
+    ).hexdigest()
+    path = cache_path(key, cache_dir)
+
+    if os.path.exists(path):
+        try:
+            data = load_frame(path)
+            # the modification time marks when an entry was last used
+            os.utime(path)
+            count('file_cache_hit')
+            return data
+        except (OSError, ValueError):
+            pass
+
+    count('file_cache_miss')
+    with stage('read_excel') as timing:
+        data = clean_columns(pd.read_excel(file_path, skiprows=skiprows),
+                             columns)
+        timing['rows'] = len(data)
+    data = data.reset_index(drop=True)
+    save_frame(data, path)
+    evict(cache_dir, max_bytes)
+    return data
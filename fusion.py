@@ -0,0 +1,184 @@
+"""
+Fusion of the sensors of one room into a single count signal.
+
+The sensors of a project room (2P02 on the ceiling, 2T01..2T04 on the
+tables) report every 5 minutes, each on its own phase. Every sensor is
+aligned to one common 5-minute grid with an as-of lookup: a grid point
+takes the last count of the sensor in the `tolerance` before the end of
+its 5 minutes. With the default tolerance that is the count inside the
+5 minutes, like the offline merged_sensors_data.xlsx (timestamps floored to
+5 minutes). The aligned sensors are combined per grid point into Count,
+which predict_occupancy_session takes like the count of a single sensor.
+
+Every sensor costs one binary search of the grid in its readings, so the
+fusion grows linearly with sensors x rows.
+
+    python fusion.py room.csv Data/Projectroom/2P02.xlsx Data/Projectroom/2T0*.xlsx
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+from compact import CompactFrame
+from sensor_store import SensorSeries, day_window
+
+GRID_MINUTES = 5
+COMBINE = ('sum', 'mean', 'max', 'first')
+
+
+def to_series(data):
+    """
+    input: DataFrame with Date and Count, SensorSeries or CompactFrame
+    output: SensorSeries sorted on time
+    """
+    if isinstance(data, SensorSeries):
+        return data
+    if isinstance(data, CompactFrame):
+        return SensorSeries(data.dates(), data.count_values())
+    data = data.dropna(subset=['Date'])
+    return SensorSeries(data['Date'].to_numpy(), data['Count'].to_numpy())
+
+
+def make_grid(series, step):
+    """
+    input: list of SensorSeries and the grid step as a timedelta64
+    output: datetime64[ns] grid from the first to the last reading of all
+    sensors, on multiples of the step
+    """
+    firsts = [s.dates[0] for s in series if len(s)]
+    if not firsts:
+        return np.zeros(0, dtype='datetime64[ns]')
+    lasts = [s.dates[-1] for s in series if len(s)]
+    step_ns = step.astype('timedelta64[ns]').astype(np.int64)
+    first = min(firsts).astype(np.int64) // step_ns * step_ns
+    last = max(lasts).astype(np.int64) // step_ns * step_ns
+    return np.arange(first, last + step_ns, step_ns).astype('datetime64[ns]')
+
+
+def align(series, grid, step, tolerance):
+    """
+    input: SensorSeries, grid, step and tolerance as timedelta64
+    output: float array with the count of the sensor at every grid point, the
+    last count before the end of the grid step and at most tolerance
+    before it, NaN when there is none
+
+    Readings without a count (the sensors also send status messages) are
+    skipped, so they don't hide a count in the same 5 minutes.
+    """
+    values = np.full(len(grid), np.nan)
+    valid = ~np.isnan(series.counts)
+    dates, counts = series.dates[valid], series.counts[valid]
+    if len(dates) == 0:
+        return values
+    end = grid + step
+    last = np.searchsorted(dates, end, side='left') - 1
+    found = last >= 0
+    last = np.maximum(last, 0)
+    found &= end - dates[last] <= tolerance
+    values[found] = counts[last[found]]
+    return values
+
+
+def combine(aligned, how='sum', weights=None):
+    """
+    input: array (sensors, grid points) of aligned counts, one of COMBINE
+    and optional weights per sensor
+    output: combined count per grid point, NaN where no sensor has a count
+
+    'first' takes the first sensor with a count, so the sensors are in
+    order of preference.
+    """
+    if how not in COMBINE:
+        raise ValueError(f'how should be one of {", ".join(COMBINE)}')
+    if weights is not None:
+        aligned = aligned * np.asarray(weights, dtype=float)[:, None]
+    missing = np.isnan(aligned).all(axis=0)
+    if how == 'first':
+        first = np.argmax(~np.isnan(aligned), axis=0)
+        combined = aligned[first, np.arange(aligned.shape[1])]
+    elif how == 'sum':
+        combined = np.nansum(aligned, axis=0)
+    else:
+        filled = np.where(np.isnan(aligned), 0.0 if how == 'mean' else
+                          -np.inf, aligned)
+        if how == 'max':
+            combined = filled.max(axis=0)
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                combined = filled.sum(axis=0) / (~np.isnan(aligned)).sum(
+                    axis=0)
+    combined = combined.astype(float)
+    combined[missing] = np.nan
+    return combined
+
+
+def fuse_sensors(sensors, how='sum', weights=None,
+                 step_minutes=GRID_MINUTES, tolerance_minutes=None,
+                 keep_empty=False):
+    """
+    input: dict sensor name -> data (DataFrame, SensorSeries or
+    CompactFrame), how to combine them, optional weights per sensor, the
+    grid step and as-of tolerance (the step by default) in minutes
+    output: DataFrame with Date, Count (the combined signal), Sensors (the
+    number of sensors with a count) and a Count_<sensor> column per sensor
+
+    Grid points where no sensor has a count are left out unless
+    keep_empty is set, like the offline merge.
+    """
+    names = list(sensors)
+    series = [to_series(sensors[name]) for name in names]
+    step = np.timedelta64(int(step_minutes * 60), 's')
+    tolerance = step if tolerance_minutes is None else np.timedelta64(
+        int(tolerance_minutes * 60), 's')
+    grid = make_grid(series, step)
+    # rows are sensors, like the weights
+    aligned = np.empty((len(series), len(grid)))
+    for row, sensor_series in enumerate(series):
+        aligned[row] = align(sensor_series, grid, step, tolerance)
+    if isinstance(weights, dict):
+        weights = [weights.get(name, 1.0) for name in names]
+
+    present = ~np.isnan(aligned)
+    keep = slice(None) if keep_empty else present.any(axis=0)
+    fused = pd.DataFrame({
+        'Date': grid[keep],
+        'Count': combine(aligned, how, weights)[keep],
+        'Sensors': present.sum(axis=0)[keep],
+    })
+    for row, name in enumerate(names):
+        fused[f'Count_{name}'] = aligned[row][keep]
+    return fused
+
+
+def load_room(file_paths):
+    """
+    input: list of sensor files of one room
+    output: dict sensor name -> Date/Count frame, in the order of the files
+    """
+    from parallel import load_sensor_file, sensor_name
+
+    return {sensor_name(file_path): load_sensor_file(file_path)
+            for file_path in file_paths}
+
+
+def predict_room(sensors, date, occupancy_mode='Exact', render=True,
+                 **fuse_options):
+    """
+    input: dict sensor name -> data of one room, the date and the options of
+    fuse_sensors
+    output: the image and session stats of predict_occupancy_session on the
+    combined signal of that day
+    """
+    from model import predict_occupancy_session
+
+    fused = fuse_sensors(sensors, **fuse_options)[['Date', 'Count']]
+    return predict_occupancy_session(day_window(fused, date), date,
+                                     occupancy_mode, render=render)
+
+
+if __name__ == '__main__':
+    fused = fuse_sensors(load_room(sys.argv[2:]))
+    fused.to_csv(sys.argv[1], index=False)
+    print(f'{len(fused)} rows of {len(sys.argv) - 2} sensors written to '
+          f'{sys.argv[1]}')
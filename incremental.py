@@ -0,0 +1,186 @@
+import hashlib
+import os
+import pickle
+
+import pandas as pd
+
+from model import predict_occupancy_session
+from segmentation import default_params
+
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache',
+                         'incremental')
+
+
+def day_session_table(day_data, date, occupancy_mode='Exact'):
+    """
+    input: Date/Count rows of one day
+    output: session stats of that day with the Date column in front, like the
+    csv of the "process all dates" mode
+    """
+    _, session_stats = predict_occupancy_session(day_data, str(date),
+                                                 occupancy_mode, render=False)
+    session_stats = pd.DataFrame(session_stats)
+    session_stats.insert(0, 'Date', date)
+    return session_stats
+
+
+def session_table(data, occupancy_mode='Exact'):
+    """
+    input: cleaned Date/Count frame
+    output: session stats of every day, computed from scratch
+    """
+    days = data['Date'].dt.normalize()
+    tables = [day_session_table(day_data, day.date(), occupancy_mode)
+              for day, day_data in data.groupby(days, sort=False)]
+    if not tables:
+        return pd.DataFrame()
+    return pd.concat(tables, ignore_index=True)
+
+
+def day_digests(data):
+    """
+    input: Date/Count frame sorted on time
+    output: dict date -> hash of the rows of that day, a day is segmented
+    again when its hash changes
+    """
+    days = data['Date'].dt.normalize()
+    digests = {}
+    for day, day_data in data.groupby(days, sort=False):
+        digest = hashlib.sha1(
+            day_data['Date'].to_numpy(dtype='datetime64[ns]').tobytes())
+        digest.update(day_data['Count'].to_numpy(dtype=float).tobytes())
+        digests[day.date()] = digest.hexdigest()
+    return digests
+
+
+def params_key():
+    """
+    output: short hash of the segmentation parameters, states made with other
+    parameters are not used
+    """
+    params = repr(tuple(default_params().items()))
+    return hashlib.sha1(params.encode()).hexdigest()[:12]
+
+
+class IncrementalProcessor:
+    """
+    Keeps the session table of one sensor up to date when its export grows.
+
+    Sessions never cross midnight, so a day only has to be segmented again
+    when its rows change. The state is the timestamp of the last processed
+    row, the rows of that (still open) day, a hash of the rows of every day
+    and the session table, so an update costs the size of the export, not of
+    the history.
+
+    The newest export is taken as it is for every day it has: a revised
+    count replaces the old reading of its timestamp, like a full recompute
+    of the export. Days that are not in the export are kept. An export that
+    starts in the open day (only the new rows) continues from the stored
+    rows of that day.
+    """
+
+    def __init__(self, sensor, state_dir=STATE_DIR, occupancy_mode='Exact'):
+        self.sensor = sensor
+        self.occupancy_mode = occupancy_mode
+        self.path = os.path.join(state_dir, sensor, occupancy_mode,
+                                 f'{params_key()}.pkl')
+        self.last_timestamp = None
+        self.open_rows = pd.DataFrame({
+            'Date': pd.Series(dtype='datetime64[ns]'),
+            'Count': pd.Series(dtype=float)})
+        self.digests = {}
+        self.table = pd.DataFrame()
+        # the days recomputed by the last update, including days without
+        # sessions
+        self.updated_days = []
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        self.last_timestamp = state['last_timestamp']
+        self.open_rows = state['open_rows']
+        self.digests = state['digests']
+        self.table = state['table']
+
+    def save(self):
+        # one file, replaced at once, so a crash never leaves the rows and
+        # the table of different updates
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'last_timestamp': self.last_timestamp,
+                         'open_rows': self.open_rows,
+                         'digests': self.digests, 'table': self.table}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def update(self, data):
+        """
+        input: cleaned Date/Count frame, may overlap with rows that were
+        already processed
+        output: the session rows of the days that were (re)computed
+        """
+        data = data[['Date', 'Count']].dropna(subset=['Date'])
+        data = data.sort_values('Date', kind='stable', ignore_index=True)
+        self.updated_days = []
+        if data.empty:
+            return self.table.iloc[:0]
+
+        first = data['Date'].iloc[0]
+        if (self.last_timestamp is not None and first.normalize() ==
+                self.last_timestamp.normalize()):
+            # the export starts in the open day, its earlier rows are only
+            # in the state
+            earlier = self.open_rows[self.open_rows['Date'] < first]
+            data = pd.concat([earlier, data], ignore_index=True)
+
+        digests = day_digests(data)
+        self.updated_days = sorted(day for day, digest in digests.items()
+                                   if self.digests.get(day) != digest)
+        if not self.updated_days:
+            return self.table.iloc[:0]
+
+        days = data['Date'].dt.date
+        new_table = session_table(data[days.isin(self.updated_days)],
+                                  self.occupancy_mode)
+        if not self.table.empty:
+            self.table = self.table[~self.table['Date'].isin(
+                self.updated_days)]
+        self.table = pd.concat([self.table, new_table], ignore_index=True)
+        self.table = self.table.sort_values('Date', kind='stable',
+                                            ignore_index=True)
+        self.digests.update(digests)
+
+        last = data['Date'].iloc[-1]
+        if self.last_timestamp is None or last >= self.last_timestamp:
+            self.last_timestamp = last
+            self.open_rows = data[days == last.date()].reset_index(drop=True)
+        self.save()
+        return new_table
+
+    def sessions(self):
+        return self.table.copy()
+
+
+def update_from_file(file_path, state_dir=STATE_DIR, occupancy_mode='Exact',
+                     rollup=None):
+    """
+    input: path of a (growing) sensor export, optionally a
+    rollup.RollupStore to update with the changed days
+    output: the session rows that changed since the last update
+
+    The sensor is named after the file, so 2.P02.xlsx and the later
+    2P.02.xlsx export share their state.
+    """
+    from parallel import load_sensor_file, sensor_name
+
+    # 2.P02, 2P.02 and 2P02 are names of the same sensor
+    sensor = sensor_name(file_path).replace('.', '')
+    processor = IncrementalProcessor(sensor, state_dir, occupancy_mode)
+    new_table = processor.update(load_sensor_file(file_path))
+    if rollup is not None and processor.updated_days:
+        rollup.update(sensor, processor.updated_days, new_table)
+    return new_table
@@ -0,0 +1,397 @@
+import csv
+import io
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+INGEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'ingest')
+FLUSH_SECONDS = 1.0
+# the writer flushes early when this many readings are waiting
+MAX_PENDING_ROWS = 50000
+# this many segments of the same level are merged into one of the next level
+COMPACT_SEGMENTS = 16
+SENSOR_NAME = re.compile(r'^[A-Za-z0-9._-]+$')
+# <sequence>.npz for a flushed segment, <first>-<last>-<level>.npz for the
+# merged segments first..last
+SEGMENT_NAME = re.compile(r'^(\d+)(?:-(\d+)-(\d+))?\.npz$')
+COLUMNS = ('Date', 'Count', 'RSSI', 'SNR')
+
+
+class IngestError(ValueError):
+    pass
+
+
+def check_sensor(sensor):
+    sensor = str(sensor)
+    if not SENSOR_NAME.match(sensor) or sensor in ('.', '..'):
+        raise IngestError(f'invalid sensor name {sensor!r}')
+    return sensor
+
+
+def to_float(value):
+    if value is None or value == '':
+        return np.nan
+    return float(value)
+
+
+def parse_rows(rows):
+    """
+    input: iterable of dicts with sensor, time, count and optional rssi/snr
+    output: dict sensor -> dict of column arrays
+    """
+    sensors, times, counts, rssi, snr = [], [], [], [], []
+    for number, row in enumerate(rows):
+        try:
+            sensors.append(row['sensor'])
+            times.append(row['time'])
+            counts.append(to_float(row.get('count')))
+            rssi.append(to_float(row.get('rssi')))
+            snr.append(to_float(row.get('snr')))
+        except (KeyError, TypeError, ValueError) as error:
+            raise IngestError(f'reading {number}: {error}') from error
+
+    # the times of the whole batch are parsed at once
+    try:
+        dates = pd.to_datetime(times, format='ISO8601').to_numpy(
+            dtype='datetime64[ns]')
+    except (TypeError, ValueError) as error:
+        raise IngestError(
+            f'invalid time: {str(error).splitlines()[0]}') from error
+
+    names, sensor_index = np.unique(np.array(sensors, dtype=str),
+                                    return_inverse=True)
+    for name in names:
+        check_sensor(name)
+    order = np.argsort(sensor_index, kind='stable')
+    bounds = np.searchsorted(sensor_index[order], np.arange(len(names) + 1))
+    columns = {'Date': dates, 'Count': np.array(counts, dtype=float),
+               'RSSI': np.array(rssi, dtype=float),
+               'SNR': np.array(snr, dtype=float)}
+    batches = {}
+    for index, name in enumerate(names):
+        rows = order[bounds[index]:bounds[index + 1]]
+        batches[str(name)] = {column: values[rows]
+                              for column, values in columns.items()}
+    return batches
+
+
+def parse_json(payload):
+    """
+    input: {"readings": [...]} or a list of readings, a reading is
+    {"sensor": "2.P01", "time": "2024-05-01T09:00:00", "count": 12}
+    output: dict sensor -> dict of column arrays
+    """
+    if isinstance(payload, dict):
+        payload = payload.get('readings')
+    if not isinstance(payload, list):
+        raise IngestError('expected a list of readings')
+    if not all(isinstance(row, dict) for row in payload):
+        raise IngestError('every reading must be an object')
+    return parse_rows(payload)
+
+
+def parse_csv(text):
+    """
+    input: csv text with a sensor,time,count[,rssi,snr] header
+    output: dict sensor -> dict of column arrays
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    if reader.fieldnames is None or not {'sensor', 'time'} <= set(
+            reader.fieldnames):
+        raise IngestError('csv needs a sensor,time,count header')
+    return parse_rows(reader)
+
+
+class SegmentWriter:
+    """
+    Collects pushed readings in memory and writes them to disk in the
+    background.
+
+    Every flush appends one segment per sensor: a .npz file with the Date,
+    Count, RSSI and SNR columns, named after a sequence number. Segments are
+    never changed afterwards, load() concatenates them. Requests only append
+    to the in-memory buffer, so their speed doesn't depend on the disk.
+
+    A gateway that pushes every few minutes gives a segment per reading, so
+    every compact_segments segments of the same level are merged into one
+    segment of the next level (see compact). A sensor keeps at most
+    compact_segments segments per level and every reading is rewritten once
+    per level, a year of 5-minute readings is 105k segments but 4 levels.
+
+    A flush that fails (disk full, permissions) puts the readings it didn't
+    write back in the buffer and is tried again on the next flush, until
+    then healthy() is False.
+    """
+
+    def __init__(self, segment_dir=INGEST_DIR, flush_seconds=FLUSH_SECONDS,
+                 max_pending_rows=MAX_PENDING_ROWS,
+                 compact_segments=COMPACT_SEGMENTS):
+        self.segment_dir = segment_dir
+        self.flush_seconds = flush_seconds
+        self.max_pending_rows = max_pending_rows
+        self.compact_segments = compact_segments
+        self.pending = {}
+        self.pending_rows = 0
+        self.sequence = {}
+        self.rows_received = 0
+        self.rows_written = 0
+        self.segments_written = 0
+        self.segments_compacted = 0
+        self.flush_errors = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+        # flushes are written one at a time, in the order they were taken
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the flush thread, once
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='ingest-flush')
+                self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # the readings are back in the buffer, the next flush
+                # tries them again
+                logging.exception('Writing ingested readings failed')
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def healthy(self):
+        """
+        output: False when the flush thread isn't running or the last flush
+        failed
+        """
+        with self.lock:
+            failing = self.last_error is not None
+        return self.alive() and not failing
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def add(self, batches):
+        """
+        input: dict sensor -> dict of column arrays, from parse_json/parse_csv
+        output: the number of readings added
+        """
+        rows = sum(len(columns['Date']) for columns in batches.values())
+        with self.lock:
+            for sensor, columns in batches.items():
+                self.pending.setdefault(sensor, []).append(columns)
+            self.pending_rows += rows
+            self.rows_received += rows
+            full = self.pending_rows >= self.max_pending_rows
+        if full:
+            self.wake.set()
+        return rows
+
+    def flush(self):
+        """
+        Writes all pending readings, output: the number of readings written
+        """
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.pending_rows = 0
+            rows = 0
+            written = []
+            try:
+                for sensor, batches in pending.items():
+                    columns = {column: np.concatenate([batch[column]
+                                                       for batch in batches])
+                               for column in COLUMNS}
+                    self.write_segment(sensor, columns)
+                    rows += len(columns['Date'])
+                    written.append(sensor)
+                    self.try_compact(sensor)
+            except Exception as error:
+                with self.lock:
+                    self.flush_errors += 1
+                    self.last_error = f'{type(error).__name__}: {error}'
+                self.put_back({sensor: batches
+                               for sensor, batches in pending.items()
+                               if sensor not in written})
+                raise
+            else:
+                with self.lock:
+                    self.last_error = None
+            finally:
+                with self.lock:
+                    self.rows_written += rows
+                    self.segments_written += len(written)
+            return rows
+
+    def put_back(self, pending):
+        """
+        Puts readings that weren't written in front of the buffer again
+        """
+        with self.lock:
+            for sensor, batches in pending.items():
+                self.pending[sensor] = batches + self.pending.get(sensor, [])
+                self.pending_rows += sum(len(batch['Date'])
+                                         for batch in batches)
+
+    def sensor_dir(self, sensor):
+        return os.path.join(self.segment_dir, check_sensor(sensor))
+
+    def next_sequence(self, sensor):
+        if sensor not in self.sequence:
+            existing = [last for _, last, _, _ in self.segments(sensor)]
+            self.sequence[sensor] = max(existing, default=0)
+        self.sequence[sensor] += 1
+        return self.sequence[sensor]
+
+    def write_segment(self, sensor, columns, name=None):
+        """
+        Writes a segment, named after the next sequence number by default
+        """
+        directory = self.sensor_dir(sensor)
+        os.makedirs(directory, exist_ok=True)
+        if name is None:
+            name = f'{self.next_sequence(sensor):08d}.npz'
+        path = os.path.join(directory, name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **columns)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def segments(self, sensor):
+        """
+        output: list of (first, last, level, name) of the segments of the
+        sensor in sequence order
+
+        A segment that is part of a merged one is left out, it is still
+        there when compact stopped before removing it.
+        """
+        directory = self.sensor_dir(sensor)
+        if not os.path.isdir(directory):
+            return []
+        found = []
+        for name in os.listdir(directory):
+            match = SEGMENT_NAME.match(name)
+            if match is None:
+                continue
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            found.append((first, last, int(match.group(3) or 0), name))
+        segments = []
+        for segment in sorted(found, key=lambda s: (s[0], -s[1])):
+            if segments and segment[1] <= segments[-1][1]:
+                continue
+            segments.append(segment)
+        return segments
+
+    def segment_names(self, sensor):
+        return [name for _, _, _, name in self.segments(sensor)]
+
+    def compact(self, sensor):
+        """
+        Merges the last compact_segments segments of the sensor when they
+        have the same level, again for the next level. output: the number of
+        segments that were merged
+
+        The merged segment is written before the old ones are removed, a
+        crash in between leaves segments that segments() skips.
+        """
+        directory = self.sensor_dir(sensor)
+        merged = 0
+        while True:
+            segments = self.segments(sensor)
+            tail = segments[-self.compact_segments:]
+            level = tail[0][2] if tail else 0
+            if len(tail) < self.compact_segments or any(
+                    segment[2] != level for segment in tail):
+                return merged
+            parts = {column: [] for column in COLUMNS}
+            for _, _, _, name in tail:
+                with np.load(os.path.join(directory, name)) as segment:
+                    for column in COLUMNS:
+                        parts[column].append(segment[column])
+            columns = {column: np.concatenate(parts[column])
+                       for column in COLUMNS}
+            order = np.argsort(columns['Date'], kind='stable')
+            self.write_segment(
+                sensor, {column: values[order]
+                         for column, values in columns.items()},
+                f'{tail[0][0]:08d}-{tail[-1][1]:08d}-{level + 1}.npz')
+            for _, _, _, name in tail:
+                os.remove(os.path.join(directory, name))
+            merged += len(tail)
+            with self.lock:
+                self.segments_compacted += len(tail)
+
+    def try_compact(self, sensor):
+        # the readings are written already, a compaction that fails is
+        # tried again after the next flush of the sensor
+        try:
+            self.compact(sensor)
+        except Exception:
+            logging.exception(f'Compacting the segments of {sensor} failed')
+
+    def sensors(self):
+        if not os.path.isdir(self.segment_dir):
+            return []
+        return sorted(name for name in os.listdir(self.segment_dir)
+                      if os.path.isdir(os.path.join(self.segment_dir, name)))
+
+    def load(self, sensor):
+        """
+        input: sensor name
+        output: DataFrame with Date, Count, RSSI and SNR of all written
+        segments of the sensor, sorted on Date
+        """
+        directory = self.sensor_dir(sensor)
+        parts = {column: [] for column in COLUMNS}
+        for name in self.segment_names(sensor):
+            with np.load(os.path.join(directory, name)) as segment:
+                for column in COLUMNS:
+                    parts[column].append(segment[column])
+        if not parts['Date']:
+            data = pd.DataFrame({'Date': pd.Series(dtype='datetime64[ns]')})
+            for column in COLUMNS[1:]:
+                data[column] = pd.Series(dtype=float)
+            return data
+        data = pd.DataFrame({column: np.concatenate(parts[column])
+                             for column in COLUMNS})
+        return data.sort_values('Date', kind='stable').reset_index(drop=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rows_received': self.rows_received,
+                'rows_written': self.rows_written,
+                'rows_pending': self.pending_rows,
+                'segments_written': self.segments_written,
+                'segments_compacted': self.segments_compacted,
+                'flush_errors': self.flush_errors,
+                'last_error': self.last_error,
+            }
@@ -0,0 +1,395 @@
+"""
+Lightweight instrumentation of the upload and prediction pipeline.
+
+Every request (or background job) gets a Trace, the code marks its stages
+with `with stage('segment', rows=len(data)):`. A stage records its wall time
+and number of rows in the trace of the current thread and in process-wide
+histograms, count() records events like cache hits. The histograms are
+rendered in the Prometheus text format by render_metrics(), the last traces
+are kept for recent_traces().
+
+Stages outside of a trace are only counted in the histograms, so the model
+functions can be called from notebooks as before.
+"""
+import cProfile
+import logging
+import math
+import os
+import pstats
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets in seconds, +Inf is added
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+RECENT_TRACES = 50
+PREFIX = 'occupancy'
+
+current = threading.local()
+# only one request is profiled at a time, profilers of different threads
+# get in each other's way on newer Pythons
+profile_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Process-wide histograms and counters, keyed by metric name and labels.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def observe(self, metric, value, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self):
+        """
+        output: all metrics in the Prometheus text format
+        """
+        with self.lock:
+            histograms = {key: (list(histogram.counts), histogram.sum,
+                                histogram.count, histogram.buckets)
+                          for key, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines += self.header(name, 'histogram')
+            for (metric, labels), (counts, total, count, buckets) in sorted(
+                    histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    lines.append(f'{name}_bucket'
+                                 f'{format_labels(labels, le=le)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total!r}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        for name in sorted({name for name, _ in counters}):
+            lines += self.header(name, 'counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def header(self, name, kind):
+        lines = []
+        if name in self.help:
+            lines.append(f'# HELP {name} {self.help[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+        return lines
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    text = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+    return '{' + text + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+registry = Registry()
+registry.describe(f'{PREFIX}_request_seconds',
+                  'Wall time of requests and background jobs')
+registry.describe(f'{PREFIX}_stage_seconds', 'Wall time of pipeline stages')
+registry.describe(f'{PREFIX}_stage_rows_total', 'Rows handled per stage')
+registry.describe(f'{PREFIX}_events_total', 'Cache hits, misses and such')
+
+recent = deque(maxlen=RECENT_TRACES)
+recent_lock = threading.Lock()
+
+
+class Trace:
+    """
+    The stages and events of one request or job. Nested stages get a higher
+    depth, so the trace reads like a call tree.
+    """
+
+    def __init__(self, name, trace_id=None, collect_only=False):
+        self.id = trace_id or uuid.uuid4().hex
+        self.name = name
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.stages = []
+        self.counters = {}
+        self.depth = 0
+        self.profile = None
+        self.profile_threshold = None
+        self.profile_path = None
+        # profiles of the calls this trace ran in worker processes
+        self.worker_profiles = []
+        # traces of worker processes are sent back instead of counted here
+        self.collect_only = collect_only
+
+    def add_stage(self, name, seconds, rows=None, depth=None):
+        entry = {'stage': name, 'seconds': seconds, 'rows': rows,
+                 'depth': self.depth if depth is None else depth}
+        self.stages.append(entry)
+        return entry
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        return {
+            'trace_id': self.id,
+            'name': self.name,
+            'started': self.started,
+            'seconds': self.seconds,
+            'stages': list(self.stages),
+            'counters': dict(self.counters),
+            'profile': self.profile_path,
+        }
+
+
+def current_trace():
+    return getattr(current, 'trace', None)
+
+
+def start_trace(name, trace_id=None, profile_threshold=None):
+    """
+    input: name of the request or job, optionally the id to use and a
+    latency threshold in seconds above which the trace keeps a cProfile
+    output: the Trace, which is now the trace of this thread
+    """
+    trace = Trace(name, trace_id)
+    if profile_threshold is not None and profile_lock.acquire(blocking=False):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            trace.profile = profile
+        except ValueError:
+            # another profiler is already running
+            profile_lock.release()
+    trace.profile_threshold = profile_threshold
+    current.trace = trace
+    return trace
+
+
+def finish_trace(trace, profile_dir=None):
+    """
+    Ends the trace of this thread, records its wall time and keeps it in the
+    recent traces. The cProfile is saved in profile_dir when the trace was
+    slower than its threshold, together with the profiles of its calls in
+    worker processes (see call_traced).
+    """
+    trace.seconds = time.perf_counter() - trace.start
+    profiles = []
+    if trace.profile is not None:
+        trace.profile.disable()
+        profile_lock.release()
+        profiles.append(trace.profile)
+        trace.profile = None
+    profiles += trace.worker_profiles
+    trace.worker_profiles = []
+    if (profiles and profile_dir and
+            trace.seconds >= trace.profile_threshold):
+        os.makedirs(profile_dir, exist_ok=True)
+        trace.profile_path = os.path.join(
+            profile_dir, f'{trace.name}-{trace.id}.prof')
+        pstats.Stats(*profiles).dump_stats(trace.profile_path)
+        logging.warning(f'{trace.name} took {trace.seconds:.2f} s, '
+                        f'profile saved to {trace.profile_path}')
+    if current_trace() is trace:
+        current.trace = None
+
+    registry.observe(f'{PREFIX}_request_seconds', trace.seconds,
+                     name=trace.name)
+    with recent_lock:
+        recent.append(trace.to_dict())
+    return trace
+
+
+@contextmanager
+def trace(name, trace_id=None, profile_threshold=None, profile_dir=None):
+    """
+    Traces the code in the with block, for background jobs
+    """
+    previous = current_trace()
+    result = start_trace(name, trace_id, profile_threshold)
+    try:
+        yield result
+    finally:
+        finish_trace(result, profile_dir)
+        current.trace = previous
+
+
+@contextmanager
+def stage(name, rows=None):
+    """
+    Times the code in the with block as a stage of the current trace. The
+    block gets a dict, set its 'rows' when they are only known at the end.
+    """
+    trace = current_trace()
+    info = {'rows': rows}
+    entry = None
+    if trace is not None:
+        # added before running, so stages are listed in the order they start
+        entry = trace.add_stage(name, None, rows)
+        trace.depth += 1
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - start
+        if entry is not None:
+            entry['seconds'] = seconds
+            entry['rows'] = info['rows']
+            trace.depth -= 1
+        if trace is None or not trace.collect_only:
+            record_stage(name, seconds, info['rows'])
+
+
+def record_stage(name, seconds, rows=None):
+    registry.observe(f'{PREFIX}_stage_seconds', seconds, stage=name)
+    if rows is not None:
+        registry.inc(f'{PREFIX}_stage_rows_total', rows, stage=name)
+
+
+def count(name, value=1):
+    """
+    Counts an event, like a cache hit, in the current trace and the metrics
+    """
+    trace = current_trace()
+    if trace is not None:
+        trace.count(name, value)
+    if trace is None or not trace.collect_only:
+        registry.inc(f'{PREFIX}_events_total', value, event=name)
+
+
+class WorkerProfile:
+    """
+    The stats of a cProfile made in a worker process, pstats.Stats takes it
+    like a Profile
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profiling():
+    """
+    output: True when the current trace keeps a profile, the calls it sends
+    to worker processes are profiled as well then
+    """
+    trace = current_trace()
+    return trace is not None and trace.profile_threshold is not None
+
+
+def call_traced(func, *args, profile=False):
+    """
+    Calls func(*args) in a worker process, profiled with profile=True
+    output: (result, stages, counters, profile stats or None) of the call,
+    pass the last three to merge() in the process that submitted it
+    """
+    previous = current_trace()
+    current.trace = Trace(func.__name__, collect_only=True)
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already running in this process
+            profiler = None
+    try:
+        result = func(*args)
+        stats = None
+        if profiler is not None:
+            profiler.disable()
+            profiler.create_stats()
+            stats = profiler.stats
+        return result, current.trace.stages, current.trace.counters, stats
+    finally:
+        current.trace = previous
+
+
+def merge(stages, counters, profile_stats=None):
+    """
+    Adds the stages, events and profile recorded by call_traced to the
+    current trace and the metrics of this process
+    """
+    trace = current_trace()
+    for item in stages:
+        if trace is not None:
+            trace.add_stage(item['stage'], item['seconds'], item['rows'],
+                            trace.depth + item['depth'])
+        record_stage(item['stage'], item['seconds'], item['rows'])
+    for name, value in counters.items():
+        count(name, value)
+    if trace is not None and profile_stats is not None:
+        trace.worker_profiles.append(WorkerProfile(profile_stats))
+
+
+def recent_traces(limit=RECENT_TRACES):
+    """
+    output: list with the last traces as dicts, the newest first
+    """
+    with recent_lock:
+        traces = list(recent)
+    return traces[::-1][:limit]
+
+
+def render_metrics(gauges=None, counters=None):
+    """
+    input: optional dicts name -> value of extra gauges and counters that
+    are kept elsewhere, like the cache sizes
+    output: the metrics in the Prometheus text format
+    """
+    lines = [registry.render().rstrip('\n')]
+    for kind, values in (('gauge', gauges), ('counter', counters)):
+        for name, value in sorted((values or {}).items()):
+            lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+            lines.append(f'{PREFIX}_{name} {value}')
+    return '\n'.join(line for line in lines if line) + '\n'
@@ -1,26 +1,108 @@
 from flask import Flask, request, redirect, url_for, render_template, send_file, \
-    Response
+    Response, abort, jsonify, g
 import os
-from model import *
+import re
+import shutil
+from model import predict_occupancy_session, preprocess, segment_day
+from streaming import is_merged, iter_chunks, iter_day_frames
+from jobs import JobQueue
+from result_cache import ResultCache
+from file_cache import (CACHE_DIR, MAX_CACHE_BYTES, cache_path, evict,
+                        file_hash, load_frame, save_frame)
+from segmentation import default_params
+from sensor_store import as_frame, day_window
+from compact import CompactFrame
+from ingest import (INGEST_DIR, IngestError, SegmentWriter, parse_csv,
+                    parse_json)
+from rollup import RollupStore
+from instrumentation import (count, finish_trace, recent_traces,
+                             render_metrics, stage, start_trace)
 import logging
-import openpyxl
 import io
-from io import BytesIO
-import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
 import numpy as np
-import base64
-import joblib
+import pandas as pd
 
 app = Flask(__name__)
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['ALLOWED_EXTENSIONS'] = {'xlsx', 'xls'}
+# the kept copies of the uploads (the plots are drawn from them), the least
+# recently used ones are removed above this size
+app.config['SOURCES_MAX_BYTES'] = 256 * 1024 * 1024
+app.config['ALLOWED_EXTENSIONS'] = {'xlsx', 'xls', 'csv'}
+# bigger xlsx files are streamed per day instead of loaded at once, csv files
+# and merged room files (a Count_<sensor> column per sensor) always are
+app.config['STREAMING_MIN_BYTES'] = 5 * 1024 * 1024
+# keep the uploaded data as compact uint16/int32 arrays instead of DataFrames,
+# off by default. The csv output is the same, only fractions of seconds of the
+# timestamps are dropped.
+app.config['COMPACT_FRAMES'] = False
+# limits of the cache with plots, stats and summaries, set RESULT_CACHE_DIR
+# to also keep them on disk between restarts
+app.config['RESULT_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['RESULT_CACHE_MAX_ENTRIES'] = 1024
+app.config['RESULT_CACHE_DIR'] = None
+# readings pushed to /ingest are written here in the background
+app.config['INGEST_FOLDER'] = INGEST_DIR
+app.config['INGEST_FLUSH_SECONDS'] = 1.0
+# requests and jobs slower than this many seconds save a cProfile in
+# PROFILE_DIR, None turns profiling off. Jobs read it at startup, their
+# profile also has the days analysed in the process pool.
+app.config['PROFILE_THRESHOLD_SECONDS'] = None
+app.config['PROFILE_DIR'] = os.path.join('.cache', 'profiles')
 
 logging.basicConfig(level=logging.DEBUG)
 app.jinja_env.globals.update(zip=zip)
 
+jobs = JobQueue(profile_threshold=app.config['PROFILE_THRESHOLD_SECONDS'],
+               profile_dir=app.config['PROFILE_DIR'])
+result_cache = ResultCache(max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+                           max_entries=app.config['RESULT_CACHE_MAX_ENTRIES'],
+                           disk_dir=app.config['RESULT_CACHE_DIR'])
+rollups = RollupStore()
+# the flush thread is started by the first /ingest request, importing the
+# app doesn't start threads
+ingest_writer = SegmentWriter(
+    app.config['INGEST_FOLDER'],
+    flush_seconds=app.config['INGEST_FLUSH_SECONDS'])
+
+
+def sources_dir():
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'sources')
+
+
+def source_path(file_key, extension):
+    """
+    output: path of the kept copy of an upload, named after the hash of its
+    contents, so a later upload with the same name doesn't change it
+    """
+    return os.path.join(sources_dir(), f'{file_key}.{extension}')
+
+
+def keep_source(file_path):
+    """
+    input: path of a saved upload
+    output: (hash of the file, path of its kept copy), the plots of the
+    result pages are drawn from that copy
+
+    The copies are evicted like the file cache, least recently used first,
+    so there is room for this one within SOURCES_MAX_BYTES. The plots of an
+    evicted copy give a 404.
+    """
+    file_key = file_hash(file_path)
+    extension = file_path.rsplit('.', 1)[1].lower()
+    kept_path = source_path(file_key, extension)
+    if os.path.exists(kept_path):
+        os.utime(kept_path)
+        return file_key, kept_path
+    evict(sources_dir(), app.config['SOURCES_MAX_BYTES'] - os.path.getsize(
+        file_path), suffix=tuple(f'.{extension}' for extension
+                                 in app.config['ALLOWED_EXTENSIONS']))
+    os.makedirs(sources_dir(), exist_ok=True)
+    tmp_path = f'{kept_path}.{os.getpid()}.tmp'
+    shutil.copyfile(file_path, tmp_path)
+    os.replace(tmp_path, kept_path)
+    return file_key, kept_path
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config[
@@ -57,6 +139,26 @@ def summary(info, occupancy_mode):
     return output.getvalue()
 
 
+@app.before_request
+def begin_request_trace():
+    g.trace = start_trace(request.endpoint or 'unknown',
+                          profile_threshold=app.config[
+                              'PROFILE_THRESHOLD_SECONDS'])
+
+
+@app.after_request
+def add_trace_header(response):
+    if 'trace' in g:
+        response.headers['X-Trace-Id'] = g.trace.id
+    return response
+
+
+@app.teardown_request
+def end_request_trace(error=None):
+    if 'trace' in g:
+        finish_trace(g.pop('trace'), app.config['PROFILE_DIR'])
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -75,81 +177,442 @@ def upload_file():
     if file and allowed_file(file.filename):
         filename = file.filename
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        with stage('save_upload'):
+            file.save(file_path)
+            file_key, file_path = keep_source(file_path)
         logging.debug(f'File saved to {file_path}')
 
-        data = pd.read_excel(file_path, skiprows=2)
-        data = data[['Date', 'Count']]
-        data['Date'] = pd.to_datetime(data['Date'], errors='coerce')
-        data.dropna(subset=['Date'], inplace=True)
-        data = data[data['Date'].dt.hour.between(8, 24)]
-
         csv_file_name = f"{os.path.splitext(filename)[0]}_info_csv.csv"
-        csv_file_path = os.path.join(app.config['UPLOAD_FOLDER'], csv_file_name)
 
         if no_date:
-            img_data_list = []
-            summary_list = []
-            all_session_stats = []
-
-            dates = data['Date'].dt.date.unique()
-            all_data = []
-
-            for date in dates:
-                img, session_stats = process_file(data, str(date),
-                                                  occupancy_mode)
-                img_base64 = base64.b64encode(img).decode('utf-8')
-                img_data_list.append(img_base64)
-                summary_list.append(summary(session_stats, occupancy_mode))
-
-                df = pd.DataFrame(session_stats)
-                df.insert(0, 'Date', date)
-
-                all_data.append(df)
-                all_session_stats.extend(session_stats)
-
-            csv_data = pd.concat(all_data, ignore_index=True)
-            # handling the csv file
-            csv_data.to_csv(csv_file_path, index=False)
-
-            return render_template('results.html', img_data_list=img_data_list,
-                                   summary_list=summary_list,
-                                   csv_file_name=csv_file_name)
+            job = jobs.submit(process_all_dates, file_path, file_key,
+                              occupancy_mode, csv_file_name)
         elif specific_date:
-            img, session_stats = process_file(data, specific_date,
-                                              occupancy_mode)
-            logging.debug('File processed successfully')
-
-            img_base64 = base64.b64encode(img).decode('utf-8')
-
-            summary_text = summary(session_stats, occupancy_mode)
+            job = jobs.submit(process_specific_date, file_path, file_key,
+                              specific_date, occupancy_mode, csv_file_name)
+        else:
+            return redirect(request.url)
+        return redirect(url_for('job_page', job_id=job.id))
+    return redirect(request.url)
 
-            csv_data = pd.DataFrame(session_stats)
-            csv_data.to_csv(csv_file_path, index=False)
 
-            return render_template('result.html', img=img_base64,
-                                   message='Done!',
-                                   specific_date=specific_date,
-                                   summary_text=summary_text,
-                                   csv_file_name=csv_file_name)
-    return redirect(request.url)
+def process_all_dates(job, file_path, file_key, occupancy_mode,
+                      csv_file_name):
+    """
+    Background job for the "process all dates" mode, returns the template and
+    its context for the results page.
+    """
+    days, job.days_total = read_days(file_path, file_key)
+
+    dates = []
+    summary_list = []
+    all_data = []
+
+    # only the stats are computed here, the plots are rendered when the
+    # browser asks for them
+    for date, session_stats, summary_text in analyse_days(
+            job, file_key, days, occupancy_mode):
+        dates.append(str(date))
+        summary_list.append(summary_text)
+
+        df = pd.DataFrame(session_stats)
+        df.insert(0, 'Date', date)
+        all_data.append(df)
+
+    csv_data = pd.concat(all_data, ignore_index=True)
+    # handling the csv file
+    with stage('write_csv', rows=len(csv_data)):
+        csv_data.to_csv(os.path.join(app.config['UPLOAD_FOLDER'],
+                                     csv_file_name), index=False)
+
+    return 'results.html', dict(dates=dates, summary_list=summary_list,
+                                file_key=file_key,
+                                occupancy_mode=occupancy_mode,
+                                csv_file_name=csv_file_name)
+
+
+def process_specific_date(job, file_path, file_key, specific_date,
+                          occupancy_mode, csv_file_name):
+    """
+    Background job for a single date, returns the template and its context
+    for the result page.
+    """
+    data = read_day(file_path, file_key, specific_date)
+    job.days_total = 1
+    [(_, session_stats, summary_text)] = analyse_days(
+        job, file_key, [(specific_date, data)], occupancy_mode)
+    logging.debug('File processed successfully')
+
+    csv_data = pd.DataFrame(session_stats)
+    with stage('write_csv', rows=len(csv_data)):
+        csv_data.to_csv(os.path.join(app.config['UPLOAD_FOLDER'],
+                                     csv_file_name), index=False)
+
+    return 'result.html', dict(file_key=file_key,
+                               occupancy_mode=occupancy_mode, message='Done!',
+                               specific_date=specific_date,
+                               summary_text=summary_text,
+                               csv_file_name=csv_file_name)
+
+
+def result_key(kind, file_key, date, occupancy_mode):
+    """
+    Key of the result cache, results depend on the file contents, the day,
+    the occupancy mode and the segmentation parameters.
+    """
+    return (kind, file_key, str(date), occupancy_mode,
+            tuple(default_params().items()))
+
+
+def analyse_days(job, file_key, days, occupancy_mode):
+    """
+    input: the running job, hash of the uploaded file, (date, day_data) pairs
+    and the occupancy mode
+    output: list of (date, session_stats, summary_text) in the order of days
+
+    Days that are in the result cache are not processed again. The days are
+    read while the others are analysed, so a streamed upload is never in
+    memory as a whole.
+    """
+    results = {}
+    order = []
+
+    def missing_days(timing):
+        # streamed uploads are parsed while the days are read here
+        for date, day_data in days:
+            order.append(date)
+            cached = result_cache.get(
+                result_key('stats', file_key, date, occupancy_mode))
+            if cached is None:
+                count('result_cache_miss')
+                timing['rows'] += len(day_data)
+                yield date, day_data
+            else:
+                count('result_cache_hit')
+                results[date] = cached
+                job.days_done += 1
+
+    with stage('analyse_days', rows=0) as timing:
+        analysed = jobs.map_days(job, predict_occupancy_session,
+                                 missing_days(timing), occupancy_mode, False)
+    for date, (_, session_stats) in analysed:
+        results[date] = {
+            'stats': session_stats,
+            'summary': summary(session_stats, occupancy_mode),
+        }
+        result_cache.put(result_key('stats', file_key, date, occupancy_mode),
+                         results[date])
+
+    return [(date, results[date]['stats'], results[date]['summary'])
+            for date in order]
+
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return render_template('job.html', job_id=job.id)
+
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != 'done':
+        return redirect(url_for('job_page', job_id=job.id))
+    template, context = job.result
+    return render_template(template, **context)
+
+
+@app.route('/plot/<file_key>/<date>/<occupancy_mode>.png')
+def plot_image(file_key, date, occupancy_mode):
+    """
+    Renders the plot of one day of an uploaded file on demand, the file is
+    the kept copy with this hash.
+    """
+    if not re.fullmatch(r'[0-9a-f]{40}', file_key):
+        abort(404)
+    paths = [source_path(file_key, extension)
+             for extension in sorted(app.config['ALLOWED_EXTENSIONS'])]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        abort(404)
+    file_path = paths[0]
+    # the modification time marks when a kept copy was last used
+    os.utime(file_path)
+    try:
+        date = pd.Timestamp(date)
+    except ValueError:
+        date = pd.NaT
+    if pd.isna(date):
+        abort(400, 'date should look like 2024-05-01')
+    date = str(date.date())
+    key = result_key('plot', file_key, date, occupancy_mode)
+    cached = result_cache.get(key)
+    if cached is not None:
+        count('result_cache_hit')
+        return Response(cached['png'], mimetype='image/png')
+    count('result_cache_miss')
+
+    data = read_day(file_path, file_key, date)
+    if data.empty:
+        abort(404)
+
+    from render import plot_day
+
+    data, session_avgs, session_people, _ = segment_day(data)
+    with stage('render', rows=len(data)):
+        img = plot_day(as_frame(data), date, occupancy_mode, session_avgs,
+                       session_people)
+    result_cache.put(key, {'png': img})
+    return Response(img, mimetype='image/png')
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Stage timings, request latencies and cache counters in the Prometheus
+    text format.
+    """
+    cache = result_cache.stats()
+    ingest = ingest_writer.stats()
+    gauges = {
+        'result_cache_entries': cache['entries'],
+        'result_cache_bytes': cache['bytes'],
+        'ingest_rows_pending': ingest['rows_pending'],
+    }
+    # hits and misses are the result_cache_hit/miss events
+    counters = {
+        'result_cache_evictions_total': cache['evictions'],
+        'ingest_rows_received_total': ingest['rows_received'],
+        'ingest_rows_written_total': ingest['rows_written'],
+        'ingest_flush_errors_total': ingest['flush_errors'],
+    }
+    return Response(render_metrics(gauges, counters),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/traces')
+def traces():
+    """
+    The last traced requests and jobs with the time of every stage, a job's
+    trace id is its job id.
+    """
+    return jsonify(recent_traces(request.args.get('limit', 50, type=int)))
 
 
 def process_file(data, specific_date, occupancy_mode):
     logging.debug(f'Processing data for date: {specific_date}')
 
-    data = data[data['Date'].dt.date == pd.to_datetime(specific_date).date()]
+    data = as_frame(day_window(data, specific_date))
 
     logging.debug('Data filtered by specific date')
 
     threshold = 0
     consecutive_points = 1
-    img, session_stats = predict_occupancy_session(data, specific_date,
-                                                   occupancy_mode)
+    with stage('process_file', rows=len(data)):
+        img, session_stats = predict_occupancy_session(data, specific_date,
+                                                       occupancy_mode)
     logging.debug('Valid peaks shown')
     return img, session_stats
 
 
+def streamed(file_path):
+    """
+    output: True when the file is read per day by streaming.iter_chunks:
+    csv files, merged room files and xlsx files over STREAMING_MIN_BYTES
+    """
+    extension = file_path.rsplit('.', 1)[1].lower()
+    if extension == 'csv':
+        return True
+    if extension != 'xlsx':
+        return False
+    if os.path.getsize(file_path) > app.config['STREAMING_MIN_BYTES']:
+        return True
+    try:
+        return is_merged(file_path)
+    except ValueError:
+        # no header found, preprocess gives the error
+        return False
+
+
+def streamed_path(file_key):
+    """
+    output: path of the rows of a streamed upload in the file cache, the
+    rows are kept there after the first pass over the file
+    """
+    return cache_path(f'{file_key}-streamed')
+
+
+def load_streamed(file_key):
+    """
+    output: the cleaned Date/Count rows of a streamed upload from the file
+    cache, None when they aren't there
+    """
+    path = streamed_path(file_key)
+    if not os.path.exists(path):
+        return None
+    try:
+        data = load_frame(path)
+    except (OSError, ValueError):
+        return None
+    # the modification time marks when an entry was last used
+    os.utime(path)
+    count('file_cache_hit')
+    if app.config['COMPACT_FRAMES']:
+        data = CompactFrame.from_frame(data)
+    return data
+
+
+def keep_streamed(days, file_key):
+    """
+    input: (date, day_data) pairs of iter_day_frames
+    output: the same pairs, once all of them are read the rows are saved in
+    the file cache, so the plots of the days don't read the file again
+    """
+    dates, counts = [], []
+    for date, day_data in days:
+        dates.append(day_data['Date'].to_numpy())
+        counts.append(day_data['Count'].to_numpy())
+        yield date, day_data
+    save_frame(pd.DataFrame({'Date': np.concatenate(dates or [[]]).astype(
+        'datetime64[ns]'), 'Count': np.concatenate(counts or [[]]).astype(
+        float)}), streamed_path(file_key))
+    evict(CACHE_DIR, MAX_CACHE_BYTES)
+
+
+def read_days(file_path, file_key):
+    """
+    input: path of an uploaded file and its hash
+    output: (iterator of (date, day_data) pairs, number of days), the days
+    are streamed or split from the preprocessed file. The number of days of
+    a streamed file is only known at the end, it is None.
+    """
+    if not streamed(file_path):
+        data = preprocess(file_path, compact=app.config['COMPACT_FRAMES'])
+        return split_days(data), count_days(data)
+    data = load_streamed(file_key)
+    if data is not None:
+        return split_days(data), count_days(data)
+    count('file_cache_miss')
+    days = keep_streamed(iter_day_frames(iter_chunks(file_path)), file_key)
+    if app.config['COMPACT_FRAMES']:
+        days = ((date, CompactFrame.from_frame(day_data))
+                for date, day_data in days)
+    return days, None
+
+
+def read_day(file_path, file_key, date):
+    """
+    input: path of an uploaded file, its hash and a date
+    output: the rows of that day, a streamed file is only read up to it when
+    its rows aren't in the file cache yet
+    """
+    if not streamed(file_path):
+        return day_window(preprocess(file_path,
+                                     compact=app.config['COMPACT_FRAMES']),
+                          date)
+    data = load_streamed(file_key)
+    if data is not None:
+        return day_window(data, date)
+    date = pd.Timestamp(date).date()
+    for day, day_data in iter_day_frames(iter_chunks(file_path)):
+        # streamed days come in chronological order
+        if day == date:
+            if app.config['COMPACT_FRAMES']:
+                return CompactFrame.from_frame(day_data)
+            return day_data
+        if day > date:
+            break
+    return pd.DataFrame({'Date': pd.Series(dtype='datetime64[ns]'),
+                         'Count': pd.Series(dtype=float)})
+
+
+def count_days(data):
+    """
+    output: the number of (date, day_data) pairs split_days gives
+    """
+    if isinstance(data, CompactFrame):
+        return data.day_count()
+    return data['Date'].dt.normalize().nunique()
+
+
+def split_days(data):
+    """
+    Splits the data into (date, day_data) pairs, grouping the frame only once
+    instead of filtering the full frame for every date. Days come in the order
+    they first appear in the data. A CompactFrame is split into views.
+    """
+    if isinstance(data, CompactFrame):
+        yield from data.days()
+        return
+    days = data['Date'].dt.normalize()
+    for day, day_data in data.groupby(days, sort=False):
+        yield day.date(), day_data
+
+
+@app.route('/ingest', methods=['POST'])
+def ingest_readings():
+    """
+    Accepts a batch of readings from a gateway, as JSON or as csv
+    (Content-Type: text/csv). The readings are written by the background
+    writer, the response only says how many were accepted. While the writer
+    can't write, readings are refused with 503 so the gateway keeps them.
+    """
+    ingest_writer.start()
+    if not ingest_writer.healthy():
+        return jsonify(error='ingest writer is not writing',
+                       **ingest_writer.stats()), 503
+    try:
+        if request.mimetype == 'text/csv':
+            batches = parse_csv(request.get_data(as_text=True))
+        elif request.is_json:
+            batches = parse_json(request.get_json(silent=True))
+        else:
+            return jsonify(error='send readings as JSON or text/csv'), 415
+    except IngestError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(accepted=ingest_writer.add(batches)), 202
+
+
+@app.route('/ingest/stats')
+def ingest_stats():
+    return jsonify(healthy=ingest_writer.healthy(), **ingest_writer.stats())
+
+
+@app.route('/rollups/<level>')
+def rollup_query(level):
+    """
+    Occupancy per hour, day or month of the sensors (?sensor=, repeatable)
+    in the [start, end) window, read from the precomputed rollups.
+    """
+    try:
+        frame = rollups.query(level, request.args.get('start'),
+                              request.args.get('end'),
+                              request.args.getlist('sensor') or None)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    frame['Sensor'] = frame['Sensor'].astype(str)
+    frame['Period'] = frame['Period'].dt.strftime('%Y-%m-%dT%H:%M')
+    frame = frame.astype(object).where(frame.notna(), None)
+    return jsonify(frame.to_dict('records'))
+
+
 @app.route('/download_csv/<filename>')
 def download_csv(filename):
     return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename),
@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from instrumentation import call_traced, merge, profiling, trace
+from parallel import make_pool
+
+# finished jobs are forgotten once there are more than this many
+MAX_JOBS = 100
+
+
+class Job:
+    """
+    State of one background job, the progress is counted in days.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.days_done = 0
+        # set by the job when it knows how many days there are, None while
+        # a streamed upload is still being read
+        self.days_total = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'days_done': self.days_done,
+            'days_total': self.days_total,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs in the background of the web app without an external broker.
+
+    Every job gets a coordinator thread, the heavy per-day work is sent to a
+    shared process pool so concurrent uploads use all cores.
+    """
+
+    def __init__(self, max_workers=None, max_jobs=4, profile_threshold=None,
+                 profile_dir=None):
+        self.max_workers = max_workers or os.cpu_count()
+        # days submitted to the pool and not collected yet, per job, so a
+        # streamed upload is only read as fast as it is analysed
+        self.max_in_flight = 2 * self.max_workers
+        # jobs slower than profile_threshold seconds save a cProfile of the
+        # coordinator thread and of their days in the process pool
+        self.profile_threshold = profile_threshold
+        self.profile_dir = profile_dir
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.coordinators = ThreadPoolExecutor(max_workers=max_jobs)
+        self.pool = None
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = make_pool(self.max_workers)
+            return self.pool
+
+    def submit(self, func, *args):
+        """
+        input: function called as func(job, *args) and its arguments
+        output: the queued Job, its result is what func returns
+        """
+        job = Job()
+        with self.lock:
+            self.jobs[job.id] = job
+            self.forget_old_jobs()
+        self.coordinators.submit(self.run, job, func, args)
+        return job
+
+    def run(self, job, func, args):
+        job.status = 'running'
+        try:
+            with trace(func.__name__, job.id, self.profile_threshold,
+                       self.profile_dir):
+                job.result = func(job, *args)
+            job.status = 'done'
+        except Exception as e:
+            logging.error(f'Job {job.id} failed\n{traceback.format_exc()}')
+            job.error = str(e)
+            job.status = 'failed'
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.status in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self.jobs) - MAX_JOBS)]:
+            del self.jobs[job_id]
+
+    def map_days(self, job, func, days, *args):
+        """
+        input: the running job, a picklable func(day_data, date, *args) and
+        an iterable of (date, day_data) pairs
+        output: list of (date, result) in the order of the days
+
+        The days are processed in the process pool, job.days_done counts the
+        finished days, job.days_total is left to the caller. The days are
+        taken from the iterable while at most max_in_flight of them are in
+        the pool, so only those are in memory. The stages timed in the
+        workers are added to the trace of the job, the days are profiled in
+        the workers when the job keeps a profile.
+        """
+        pool = self.get_pool()
+        profile = profiling()
+        results = {}
+        in_flight = {}
+
+        def collect(done):
+            for future in done:
+                index, date = in_flight.pop(future)
+                result, stages, counters, stats = future.result()
+                merge(stages, counters, stats)
+                results[index] = (date, result)
+                job.days_done += 1
+
+        for index, (date, day_data) in enumerate(days):
+            if len(in_flight) >= self.max_in_flight:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            future = pool.submit(call_traced, func, day_data, str(date),
+                                 *args, profile=profile)
+            in_flight[future] = (index, date)
+        collect(wait(in_flight).done)
+        return [results[index] for index in sorted(results)]
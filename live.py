@@ -0,0 +1,288 @@
+import heapq
+import math
+from array import array
+
+import numpy as np
+
+from segmentation import (CHANGE_THRESHOLD, MAX_SPLITS, MIN_SESSION_POINTS,
+                          SESSION_START, SESSION_STOP, SPLIT_MIN_PERIODS,
+                          SPLIT_WINDOW)
+
+OPENING_HOUR = 8
+
+
+def iqr_average(counts):
+    """
+    input: array of counts
+    output: mean of the counts inside 1.5 IQR of the quartiles, same as
+    model.remove_outliers_and_calculate_avg
+    """
+    counts = np.frombuffer(counts, dtype=np.uint16).astype(float)
+    if len(counts) == 0:
+        return math.nan
+    q1, q3 = np.quantile(counts, [0.25, 0.75])
+    iqr = q3 - q1
+    return counts[(counts >= q1 - 1.5 * iqr) & (counts <= q3 + 1.5 * iqr)
+                  ].mean()
+
+
+def classify(counts):
+    """
+    output: (IQR average, occupancy class) of the counts of a session
+    """
+    from model import find_nearest_occupancy
+
+    avg = iqr_average(counts)
+    if math.isnan(avg):
+        return avg, None
+    return avg, int(find_nearest_occupancy(avg))
+
+
+class SensorState:
+    """
+    State of the session detector of one sensor.
+
+    Same rules as segmentation.segment_sessions, applied one reading at a
+    time: a session opens at a count above start and closes (inclusive) at
+    the first count below stop. A session is only reported once it has
+    min_points readings. A session is split where the rolling average of the
+    last `window` readings jumps more than change_threshold, the rolling
+    average starts again at the split (at most max_splits times). Sessions
+    never cross midnight and readings before opening time are skipped, like
+    model.preprocess does.
+
+    The rolling window is a ring buffer of `window` counts, the valid counts
+    of the open session are kept as uint16 for the IQR average (at most one
+    day of readings).
+    """
+
+    __slots__ = ('sensor', 'last_time', 'day', 'next_session', 'session',
+                 'start', 'end', 'num_points', 'splits', 'counts',
+                 'ring', 'ring_valid', 'ring_pos', 'ring_sum', 'ring_nobs',
+                 'rows', 'previous_avg', 'people')
+
+    def __init__(self, sensor, window=SPLIT_WINDOW):
+        self.sensor = sensor
+        self.last_time = None
+        self.day = None
+        self.next_session = 1
+        self.ring = array('d', bytes(8 * window))
+        self.ring_valid = bytearray(window)
+        self.reset()
+
+    def reset(self):
+        self.session = None
+        self.start = None
+        self.end = None
+        self.num_points = 0
+        self.splits = 0
+        self.counts = array('H')
+        self.people = None
+        self.reset_window()
+
+    def reset_window(self):
+        for index in range(len(self.ring_valid)):
+            self.ring[index] = 0.0
+            self.ring_valid[index] = 0
+        self.ring_pos = 0
+        self.ring_sum = 0.0
+        self.ring_nobs = 0
+        self.rows = 0
+        self.previous_avg = math.nan
+
+    def rolling_average(self, count, min_periods):
+        """
+        Adds a reading to the ring buffer, output: the rolling average of the
+        window, NaN with fewer than min_periods valid counts
+        """
+        pos = self.ring_pos
+        if self.ring_valid[pos]:
+            self.ring_sum -= self.ring[pos]
+            self.ring_nobs -= 1
+        valid = not math.isnan(count)
+        self.ring[pos] = count if valid else 0.0
+        self.ring_valid[pos] = valid
+        if valid:
+            self.ring_sum += count
+            self.ring_nobs += 1
+        self.ring_pos = (pos + 1) % len(self.ring_valid)
+        self.rows += 1
+        if self.ring_nobs < max(min_periods, 1):
+            return math.nan
+        return self.ring_sum / self.ring_nobs
+
+
+class LiveDetector:
+    """
+    Online session detection for many sensors.
+
+    push() takes one reading and returns the events it caused, every event is
+    a dict with a 'type':
+    - 'open': a session reached min_points readings
+    - 'estimate': the occupancy class of an open session changed
+    - 'close': a session ended, with its final IQR average and class
+    """
+
+    def __init__(self, start=SESSION_START, stop=SESSION_STOP,
+                 min_points=MIN_SESSION_POINTS, window=SPLIT_WINDOW,
+                 min_periods=SPLIT_MIN_PERIODS,
+                 change_threshold=CHANGE_THRESHOLD, max_splits=MAX_SPLITS):
+        self.start = start
+        self.stop = stop
+        self.min_points = min_points
+        self.window = window
+        self.min_periods = min_periods
+        self.change_threshold = change_threshold
+        self.max_splits = max_splits
+        self.states = {}
+        self.late = 0
+
+    def state(self, sensor):
+        state = self.states.get(sensor)
+        if state is None:
+            state = self.states[sensor] = SensorState(sensor, self.window)
+        return state
+
+    def event(self, kind, state, time, **info):
+        return dict(type=kind, sensor=state.sensor, session=state.session,
+                    time=time, start=state.start, **info)
+
+    def push(self, sensor, time, count):
+        """
+        input: sensor name, timestamp (datetime) and count (NaN when missing)
+        output: list of events
+        """
+        state = self.state(sensor)
+        if state.last_time is not None and time < state.last_time:
+            # readings are expected in time order, late ones are dropped
+            self.late += 1
+            return []
+        state.last_time = time
+        if time.hour < OPENING_HOUR:
+            return []
+
+        events = []
+        day = time.date()
+        if day != state.day:
+            events += self.close(state, state.end)
+            state.day = day
+
+        count = float(count)
+        missing = math.isnan(count)
+        if state.session is None:
+            if missing or count <= self.start:
+                return events
+            self.open(state, time)
+            state.reset_window()
+
+        # the part after a jump in the rolling average becomes a new session
+        # with its own rolling average, until max_splits is reached
+        if self.max_splits is None or state.splits < self.max_splits:
+            avg = state.rolling_average(count, self.min_periods)
+            if state.rows > 1 and abs(
+                    avg - state.previous_avg) > self.change_threshold:
+                splits = state.splits + 1
+                events += self.close(state, state.end)
+                self.open(state, time)
+                state.splits = splits
+                avg = state.rolling_average(count, self.min_periods)
+            state.previous_avg = avg
+
+        state.end = time
+        state.num_points += 1
+        if not missing:
+            state.counts.append(int(count))
+
+        if state.num_points == self.min_points:
+            events.append(self.event('open', state, time))
+        if state.num_points >= self.min_points and not missing:
+            events += self.estimate(state, time)
+
+        if not missing and count < self.stop:
+            events += self.close(state, time)
+        return events
+
+    def open(self, state, time):
+        state.session = state.next_session
+        state.next_session += 1
+        state.start = time
+        state.num_points = 0
+        state.counts = array('H')
+        state.people = None
+
+    def estimate(self, state, time):
+        avg, people = classify(state.counts)
+        if people == state.people:
+            return []
+        state.people = people
+        return [self.event('estimate', state, time, avg=avg, people=people)]
+
+    def close(self, state, time):
+        """
+        Ends the open session, output: a close event when the session had
+        min_points readings
+        """
+        if state.session is None:
+            return []
+        events = []
+        if state.num_points >= self.min_points:
+            avg, people = classify(state.counts)
+            events.append(self.event('close', state, time, end=state.end,
+                                     num_points=state.num_points, avg=avg,
+                                     people=people))
+        state.session = None
+        state.splits = 0
+        state.reset_window()
+        return events
+
+    def flush(self):
+        """
+        Closes the open sessions of all sensors, output: list of events
+        """
+        events = []
+        for state in self.states.values():
+            events += self.close(state, state.end)
+        return events
+
+    def status(self):
+        """
+        output: dict sensor -> open session info, for the sensors that are
+        occupied right now
+        """
+        return {sensor: {'session': state.session, 'start': state.start,
+                         'num_points': state.num_points,
+                         'people': state.people}
+                for sensor, state in self.states.items()
+                if state.session is not None and
+                state.num_points >= self.min_points}
+
+
+def iter_readings(file_paths, loader=None):
+    """
+    input: list of sensor files
+    output: (time, sensor, count) of all files, merged in time order
+    """
+    from parallel import load_sensor_file, sensor_name
+
+    loader = loader or load_sensor_file
+
+    def readings(file_path):
+        data = loader(file_path).sort_values('Date', kind='stable')
+        sensor = sensor_name(file_path)
+        for time, count in zip(data['Date'], data['Count']):
+            yield time, sensor, count
+
+    return heapq.merge(*(readings(file_path) for file_path in file_paths),
+                       key=lambda reading: reading[0])
+
+
+def replay(file_paths, detector=None, loader=None):
+    """
+    input: list of sensor files, optionally a LiveDetector
+    output: generator of the events of feeding all readings to the detector,
+    the open sessions are closed at the end
+    """
+    detector = detector or LiveDetector()
+    for time, sensor, count in iter_readings(file_paths, loader):
+        yield from detector.push(sensor, time, count)
+    yield from detector.flush()
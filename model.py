@@ -1,27 +1,33 @@
+import os
+import threading
 import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
 import numpy as np
-from io import BytesIO
-from IPython.display import Image, display
-import matplotlib.dates as mdates
-import base64
-import joblib
+from compact import CompactFrame
+from file_cache import read_excel_cached
+from instrumentation import stage
+from segmentation import group_sessions, segment_sessions
+from sensor_store import as_frame
 
 
-def preprocess(file_path: str):
+def preprocess(file_path: str, compact=False):
     """"
-    input: raw excel file path
+    input: raw excel file path, compact=True for a CompactFrame
     output: cleaned pandas DataFrame with Date and Count columns
 
     Deals with the raw excel files, Skips first two white lines and only
     uses the Date and Count, will also drop NaN values and closed hours.
     """
-    data = pd.read_excel(file_path, skiprows=2)
-    data = data[['Date', 'Count']]
-    data['Date'] = pd.to_datetime(data['Date'], errors='coerce')
-    data.dropna(subset=['Date'], inplace=True)
-    data = data[data['Date'].dt.hour.between(8, 24)]
+    with stage('preprocess') as timing:
+        if compact:
+            data = read_excel_cached(file_path, skiprows=2,
+                                     columns=('Date', 'Count'))
+            data = CompactFrame.from_frame(data)
+            data = data.select(data.minutes % (24 * 60) >= 8 * 60)
+        else:
+            data = read_excel_cached(file_path, skiprows=2)[['Date', 'Count']]
+            data = data.dropna(subset=['Date'])
+            data = data[data['Date'].dt.hour.between(8, 24)]
+        timing['rows'] = len(data)
     return data
 
 
@@ -60,9 +66,87 @@ def summary(info, occupancy_mode):
               )
 
 
-# load the classification
-neigh = joblib.load('nearest_neighbors_model.pkl')
-occupancies = joblib.load('occupancies.pkl')
+# the classification model is stored next to this file
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILE = os.path.join(MODEL_DIR, 'nearest_neighbors_model.pkl')
+OCCUPANCIES_FILE = os.path.join(MODEL_DIR, 'occupancies.pkl')
+
+classifier_cache = {}
+classifier_lock = threading.Lock()
+
+
+def occupancy_lookup_table(neigh, occupancies):
+    """
+    output: (sorted training counts, their occupancy classes) or None
+
+    The k-NN model is fitted on a single feature, so the nearest neighbour can
+    be found with a binary search over the sorted training points. Returns
+    None when the model does not have that shape.
+    """
+    fit_x = getattr(neigh, '_fit_X', None)
+    if fit_x is None or np.ndim(fit_x) != 2 or fit_x.shape[1] != 1:
+        return None
+    points = np.asarray(fit_x, dtype=float)[:, 0]
+    order = np.argsort(points, kind='stable')
+    return points[order], np.asarray(occupancies)[order]
+
+
+def get_classifier():
+    """
+    output: dict with the k-NN model ('neigh'), the occupancy of every
+    training point ('occupancies') and the lookup table ('table')
+
+    The pickles (and with them sklearn) are loaded on first use only, from
+    the directory of this file so the working directory doesn't matter.
+    """
+    if not classifier_cache:
+        with classifier_lock:
+            if not classifier_cache:
+                import joblib
+
+                neigh = joblib.load(MODEL_FILE)
+                occupancies = joblib.load(OCCUPANCIES_FILE)
+                classifier_cache['table'] = occupancy_lookup_table(
+                    neigh, occupancies)
+                classifier_cache['occupancies'] = occupancies
+                classifier_cache['neigh'] = neigh
+    return classifier_cache
+
+
+def __getattr__(name):
+    # model.neigh, model.occupancies and model.occupancy_table still work,
+    # they load the model on first access
+    if name in ('neigh', 'occupancies'):
+        return get_classifier()[name]
+    if name == 'occupancy_table':
+        return get_classifier()['table']
+    raise AttributeError(f"module 'model' has no attribute {name!r}")
+
+
+def find_nearest_occupancies(counts):
+    """
+    input: array of average counts
+    output: array with the nearest occupancy class for every count
+
+    Classifies all counts in one call, falls back to the sklearn model when
+    the lookup table is not available.
+    """
+    classifier = get_classifier()
+    occupancies = np.asarray(classifier['occupancies'])
+    counts = np.asarray(counts, dtype=float).ravel()
+    if len(counts) == 0:
+        return occupancies[:0]
+    if classifier['table'] is None:
+        index = classifier['neigh'].kneighbors(counts.reshape(-1, 1),
+                                               return_distance=False)
+        return occupancies[index[:, 0]]
+
+    points, classes = classifier['table']
+    right = np.clip(np.searchsorted(points, counts), 0, len(points) - 1)
+    left = np.maximum(right - 1, 0)
+    # on an exact tie the lower training point wins, like the k-NN model
+    use_right = np.abs(counts - points[right]) < np.abs(counts - points[left])
+    return classes[np.where(use_right, right, left)]
 
 
 def find_nearest_occupancy(count):
@@ -72,181 +156,224 @@ def find_nearest_occupancy(count):
 
     Handeling the estimation.
     """
-    distance, index = neigh.kneighbors(np.array([[count]]),
-                                       return_distance=True)
-    nearest_occupancy = occupancies[index[0][0]]
-    return nearest_occupancy
+    return find_nearest_occupancies([count])[0]
 
 
-def predict_occupancy_session(data, date, occupancy_mode='Exact'):
+def remove_outliers_and_calculate_avg(counts):
     """"
-    This function handles the session classification and extracting information
+    Handling the outliers with the interquartile range
+    """
+    q1 = counts.quantile(0.25)
+    q3 = counts.quantile(0.75)
+    iqr = q3 - q1
+    lower_bound = q1 - 1.5 * iqr
+    upper_bound = q3 + 1.5 * iqr
+    filtered_counts = counts[
+        (counts >= lower_bound) & (counts <= upper_bound)]
+    return filtered_counts.mean()
+
+
+def grouped_quantile(values, group_starts, group_sizes, q):
+    """
+    input: values sorted within every group, start and size of the groups
+    and the quantile, every group needs at least one value
+    output: the quantile of every group, interpolated like pandas/numpy
+    (method 'linear')
+    """
+    index = (group_sizes - 1) * q
+    below = np.floor(index).astype(np.int64)
+    above = np.minimum(below + 1, group_sizes - 1)
+    gamma = index - below
+    a = values[group_starts + below]
+    b = values[group_starts + above]
+    diff = b - a
+    return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+
+def session_stats_table(sessions, counts, dates):
     """
-    data['Date'] = pd.to_datetime(data['Date'])
-    data = data.sort_values('Date')
-
-    # start values
-    session_id = 0
-    in_session = False
-    session_labels = []
-
-    # loop through the data
-    for i in range(len(data)):
-        if data['Count'].iloc[i] > 0 and not in_session:
-            in_session = True
-            session_id += 1
-
-        if in_session:
-            session_labels.append(session_id)
+    input: session ids, counts (NaN when missing) and dates of a day
+    output: DataFrame with a row per session id (0 included), in order of
+    first appearance: First (row of the first appearance), Total, Mean,
+    Std, Num_Points, IQR_Mean, Start, End and Duration (minutes)
+
+    Computes the stats of all sessions in one pass over the rows sorted by
+    session: np.add.reduceat for the sums of the counts, a sum per session of
+    the squared deviations and one sort of the counts for the IQR
+    quartiles. Missing counts are zeros in the sums, like pandas does,
+    so the values match Series.sum/mean/std.
+    """
+    sessions = np.asarray(sessions)
+    counts = np.asarray(counts, dtype=float)
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    order, ids, starts, sizes = group_sessions(sessions)
+    if len(ids) == 0:
+        return pd.DataFrame(columns=['First', 'Total', 'Mean', 'Std',
+                                     'Num_Points', 'IQR_Mean', 'Start', 'End',
+                                     'Duration'])
+
+    sorted_counts = counts[order]
+    valid = ~np.isnan(sorted_counts)
+    values = np.where(valid, sorted_counts, 0.0)
+    n = np.add.reduceat(valid.astype(np.int64), starts)
+    total = np.add.reduceat(values, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        squares = np.where(valid, (np.repeat(mean, sizes) - values) ** 2, 0.0)
+        # per session like Series.std, a reduceat over all sessions adds up
+        # in another order and changes the last bit of some stds
+        square_sums = np.array([np.add.reduce(squares[first:first + size])
+                                for first, size in zip(starts, sizes)])
+        std = np.sqrt(square_sums / (n - 1))
+    mean[n == 0] = np.nan
+    std[n < 2] = np.nan
+
+    # quartiles of the valid counts, sorted within every session
+    group = np.repeat(np.arange(len(ids)), sizes)
+    known = np.lexsort((sorted_counts[valid], group[valid]))
+    known_values = sorted_counts[valid][known]
+    known_group = group[valid][known]
+    known_starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+    has_values = n > 0
+    q1 = np.full(len(ids), np.nan)
+    q3 = np.full(len(ids), np.nan)
+    q1[has_values] = grouped_quantile(known_values, known_starts[has_values],
+                                      n[has_values], 0.25)
+    q3[has_values] = grouped_quantile(known_values, known_starts[has_values],
+                                      n[has_values], 0.75)
+    iqr = q3 - q1
+    inside = (known_values >= (q1 - 1.5 * iqr)[known_group]) & (
+        known_values <= (q3 + 1.5 * iqr)[known_group])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        iqr_mean = np.bincount(known_group, weights=known_values * inside,
+                               minlength=len(ids)) / np.bincount(
+            known_group, weights=inside, minlength=len(ids))
+
+    # rows of a session keep their time order, the first and last row of a
+    # group are its start and end
+    first = order[starts]
+    start = dates[first]
+    end = dates[order[starts + sizes - 1]]
+    table = pd.DataFrame({
+        'First': first,
+        'Total': total,
+        'Mean': mean,
+        'Std': std,
+        'Num_Points': sizes,
+        'IQR_Mean': iqr_mean,
+        'Start': start,
+        'End': end,
+        'Duration': (end - start) / np.timedelta64(1, 'm'),
+    }, index=pd.Index(ids, name='Session'))
+    return table.sort_values('First')
+
+
+def segmented_stats_table(data):
+    """
+    input: segmented DataFrame or CompactFrame of a day
+    output: session_stats_table of the day
+    """
+    if isinstance(data, CompactFrame):
+        return session_stats_table(data.sessions, data.count_values(),
+                                   data.dates())
+    return session_stats_table(data['Session'].to_numpy(),
+                               data['Count'].to_numpy(),
+                               data['Date'].to_numpy())
+
+
+def segment_day(data):
+    """
+    input: DataFrame with Date and Count columns
+    output: the data sorted on Date with a Session column, the IQR average of
+    every session, a dict with the occupancy class of every session and the
+    session_stats_table of the day
+
+    Every session is classified once, both the plot and the stats use this.
+    The stats table is computed once as well, pass it on to
+    calculate_session_stats.
+    A SensorSeries from sensor_store is accepted as well, a CompactFrame stays
+    compact.
+    """
+    with stage('segment', rows=len(data)):
+        if isinstance(data, CompactFrame):
+            sessions = segment_sessions(data.count_values())
+            data = CompactFrame(data.minutes, data.seconds, data.counts,
+                                data.valid, sessions.astype(np.int32))
         else:
-            session_labels.append(0)
-
-        if in_session and data['Count'].iloc[i] < 5:
-            in_session = False
-
-    data['Session'] = session_labels
-
-    session_counts = data['Session'].value_counts()
-    valid_sessions = session_counts[session_counts >= 6].index
-    data.loc[~data['Session'].isin(valid_sessions), 'Session'] = 0
-
-    def remove_outliers_and_calculate_avg(counts):
-        """"
-        Handling the outliers with the interquartile range
-        """
-        q1 = counts.quantile(0.25)
-        q3 = counts.quantile(0.75)
-        iqr = q3 - q1
-        lower_bound = q1 - 1.5 * iqr
-        upper_bound = q3 + 1.5 * iqr
-        filtered_counts = counts[
-            (counts >= lower_bound) & (counts <= upper_bound)]
-        return filtered_counts.mean()
-
-    def split_sessions_based_on_changes(data, window=25, change_threshold=10):
-        """
-        Rolling average handling
-        """
-        new_session_id = max(data['Session']) + 1
-        for session in data['Session'].unique():
-            if session == 0:
-                continue
-            session_data = data[data['Session'] == session]
-            if len(session_data) < 1:
-                continue
-
-            rolling_avg = session_data['Count'].rolling(window=window,
-                                                        min_periods=20).mean()
-            session_data = session_data.copy()
-            session_data['Rolling_Avg'] = rolling_avg
-
-            prev_avg = rolling_avg.iloc[0]
-            for i in range(1, len(session_data)):
-                current_avg = rolling_avg.iloc[i]
-                if abs(current_avg - prev_avg) > change_threshold:
-                    data.loc[session_data.index[i:], 'Session'] = new_session_id
-                    new_session_id += 1
-                    break
-                prev_avg = current_avg
-
-    split_sessions_based_on_changes(data)
-    session_counts = data['Session'].value_counts()
-    valid_sessions = session_counts[session_counts >= 6].index
-    data.loc[~data['Session'].isin(valid_sessions), 'Session'] = 0
-
-    def plot_day(data, date):
-        """
-        plotting the data
-        """
-        date = str(date).split()[0]
-        start_date = datetime.strptime(date, '%Y-%m-%d')
-        end_date = start_date + timedelta(days=1)
-        day_data = data[
-            (data['Date'] >= start_date) & (data['Date'] < end_date)]
-
-        plt.figure(figsize=(15, 7))
-        plt.plot(np.array(day_data['Date']), np.array(day_data['Count']),
-                 label='Noise', color='black', linewidth=1, alpha=0.5)
-
-        unique_sessions = day_data['Session'].unique()
-
-        for index, session in enumerate(unique_sessions[1:]):
-            session_data = day_data[day_data['Session'] == session]
-            volume = len(session_data)
-            avg_count = remove_outliers_and_calculate_avg(session_data['Count'])
-            people = find_nearest_occupancy(avg_count)
-            if occupancy_mode == 'Exact':
-                if people == 0:
-                    people = '1'
-                elif people > 4:
-                    people = '4+'
-                else:
-                    people = str(int(people))
-            else:
-                if avg_count < 153:
-                    people = '1-2'
-                else:
-                    people = '3+'
-            if people == '1':
-                label = f'Session {index + 1}: estimated {people} person'
-            else:
-                label = f'Session {index + 1}: estimated {people} people'
-
-            color = None
-
-            plt.plot(np.array(session_data['Date']),
-                     np.array(session_data['Count']), label=label, linewidth=2,
-                     alpha=0.5)
-
-        plt.title(
-            f'Occupancy for the sessions on {date}')
-        plt.xlabel('Time of day')
-        plt.ylabel('Movement Count')
-        plt.legend()
-        ax = plt.gca()
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-        plt.xticks(rotation=45)
-        img_buf = BytesIO()
-        plt.savefig(img_buf, format='png')
-        plt.close()
-        img_buf.seek(0)
-
-        return img_buf.getvalue()
-
-    img = plot_day(data, date)
-
-    def calculate_session_stats(data):
-        stats = []
-        for index, session in enumerate(data['Session'].unique()):
-            if session == 0:
-                continue
-            session_data = data[data['Session'] == session]
-            avg_count = remove_outliers_and_calculate_avg(session_data['Count'])
-            people = find_nearest_occupancy(avg_count)
-            if people == 0:
-                people = '1'
-            elif people > 4:
-                people = '4+'
-            else:
-                people = str(int(people))
-            total = session_data['Count'].sum()
-            mean = session_data['Count'].mean()
-            std = session_data['Count'].std()
-            num_points = len(session_data)
-            # you can append info very easily here if you wish. This is just a
-            # start example.
-            stats.append({
-                'Session': index,
-                'Total': total,
-                'Mean': mean,
-                'Std': std,
-                'Num_Points': num_points,
-                'People': people,
-            })
-        return stats
-
-    session_stats = calculate_session_stats(data)
-    session_stats_df = pd.DataFrame(session_stats)
+            data = as_frame(data)
+            data['Date'] = pd.to_datetime(data['Date'])
+            data = data.sort_values('Date')
+            data['Session'] = segment_sessions(data['Count'].to_numpy())
+
+    with stage('classify', rows=len(data)):
+        table = segmented_stats_table(data)
+        session_avgs = table['IQR_Mean'].sort_index()
+        session_people = dict(zip(session_avgs.index,
+                                  find_nearest_occupancies(session_avgs)))
+    return data, session_avgs, session_people, table
+
+
+def people_class(people):
+    if people == 0:
+        return '1'
+    elif people > 4:
+        return '4+'
+    return str(int(people))
+
+
+def calculate_session_stats(data, session_avgs, session_people, table=None):
+    """
+    input: segmented data from segment_day, the IQR averages and classes and
+    optionally the stats table from segment_day
+    output: list with a dict of stats for every session
+
+    Session is the position of the session among the session ids of the day
+    in order of appearance, 0 (no session) included.
+    """
+    if table is None:
+        table = segmented_stats_table(data)
+    table = table.assign(Position=np.arange(len(table)))
+    table = table[table.index != 0]
+    # you can append info very easily here if you wish. This is just a
+    # start example.
+    stats = pd.DataFrame({
+        'Session': table['Position'].to_numpy(),
+        'Total': table['Total'].to_numpy(),
+        'Mean': table['Mean'].to_numpy(),
+        'Std': table['Std'].to_numpy(),
+        'Num_Points': table['Num_Points'].to_numpy(),
+        'People': [people_class(session_people[session])
+                   for session in table.index],
+        'IQR_Mean': table['IQR_Mean'].to_numpy(),
+        'Start': table['Start'].to_numpy(),
+        'End': table['End'].to_numpy(),
+        'Duration': table['Duration'].to_numpy(),
+    })
+    return stats.to_dict('records')
+
+
+def predict_occupancy_session(data, date, occupancy_mode='Exact',
+                              render=True):
+    """"
+    This function handles the session classification and extracting information
+
+    With render=False only the stats are computed, the returned image is None
+    and matplotlib is not imported.
+    """
+    with stage('predict', rows=len(data)):
+        data, session_avgs, session_people, table = segment_day(data)
+
+        img = None
+        if render:
+            from render import plot_day
+            with stage('render', rows=len(data)):
+                img = plot_day(as_frame(data), date, occupancy_mode,
+                               session_avgs, session_people)
+
+        with stage('stats', rows=len(data)):
+            session_stats = calculate_session_stats(data, session_avgs,
+                                                    session_people, table)
+            session_stats_df = pd.DataFrame(session_stats)
     return img, session_stats_df
 
 
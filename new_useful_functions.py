@@ -1,12 +1,13 @@
 import pandas as pd
 import numpy as np
+from file_cache import read_excel_cached
+from segmentation import find_low_count_peaks
+from sensor_store import as_frame, day_window, time_window
 
 
 def preprocess(file_path):
-    data = pd.read_excel(file_path, skiprows=2)
-    data = data[['Date', 'Count']]
-    data['Date'] = pd.to_datetime(data['Date'], errors='coerce')
-    data.dropna(subset=['Date'], inplace=True)
+    data = read_excel_cached(file_path, skiprows=2)[['Date', 'Count']]
+    data = data.dropna(subset=['Date'])
     data = data[data['Date'].dt.hour.between(8, 24)]
     return data
 
@@ -58,13 +59,11 @@ def show_valid_peaks(data, day, threshold, consecutive_points, offset=0):
 
 
 def make_sessions(data, day, threshold, consecutive_points, offset=0):
-    mask = data['Date'].dt.strftime('%Y-%m-%d') == day
-    filtered_data = data.loc[mask].reset_index(drop=True)
+    filtered_data = as_frame(day_window(data, day)).reset_index(drop=True)
 
-    valid_peaks = [index for index in range(len(filtered_data['Count'])) if
-                   surrounded_by_low_counts(index, filtered_data['Count'],
-                                            threshold, consecutive_points) and
-                   filtered_data['Count'][index] > threshold + offset]
+    valid_peaks = find_low_count_peaks(filtered_data['Count'].to_numpy(),
+                                       threshold, consecutive_points,
+                                       offset).tolist()
     filtered_data['Session'] = (filtered_data.index.isin(valid_peaks)).cumsum()
     session_stats = filtered_data.groupby('Session')['Count'].agg(
         ['sum', 'mean', 'std', 'size']).reset_index()
@@ -141,7 +140,7 @@ def import_file(sensor_type, sensor_number):
             f"Voor sensor_number, kijk naar hoe de file heet en gebruik daarvan dus de eerste 4 karakters'\n"
             f"Examples: 'Data_clean/Locus_sensors/B.253_processed.xlsx', 'Data_clean/Alta_sensors/B.254_processed.xlsx'"
         )
-    file = pd.read_excel(file_path)
+    file = read_excel_cached(file_path)
     file.dropna(subset=['Count'], inplace=True)
     return file
 
@@ -209,8 +208,8 @@ def peaks_for_specific_timeframe(data, start_time, end_time):
     """
 
     import matplotlib.pyplot as plt
-    mask = (data['Date'] >= start_time) & (data['Date'] <= end_time)
-    filtered_data = data.loc[mask]
+    filtered_data = as_frame(time_window(data, start_time, end_time,
+                                         closed='both'))
 
     plt.figure(figsize=(10, 6))
     plt.plot(filtered_data['Date'], filtered_data['Count'], marker='o')
@@ -0,0 +1,105 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from file_cache import CACHE_DIR, read_excel_cached
+from streaming import find_header
+
+
+def sensor_name(file_path):
+    """
+    input: path of a sensor export, like Data_clean/Locus_sensors/2.B53_processed.xlsx
+    output: name of the sensor, like 2.B53
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    for suffix in ('_processed', '_combined'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def load_sensor_file(file_path, cache_dir=CACHE_DIR):
+    """
+    input: path of a raw export or a cleaned file from Data_clean
+    output: DataFrame with Date and Count, cleaned like model.preprocess
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        skiprows, _ = find_header(workbook.active.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+    data = read_excel_cached(file_path, skiprows=skiprows or None,
+                             cache_dir=cache_dir)
+    data = data[['Date', 'Count']].dropna(subset=['Date'])
+    return data[data['Date'].dt.hour.between(8, 24)]
+
+
+def init_worker():
+    """
+    Runs once in every worker process, loads the k-NN model so the tasks
+    don't have to.
+    """
+    from model import get_classifier
+
+    get_classifier()
+
+
+def make_pool(max_workers=None):
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               initializer=init_worker)
+
+
+def analyse_day(sensor, date, day_data, occupancy_mode):
+    """
+    Work unit of the parallel driver: the session stats of one sensor on one
+    day, with Sensor and Date columns in front.
+    """
+    from model import predict_occupancy_session
+
+    _, session_stats = predict_occupancy_session(day_data, str(date),
+                                                 occupancy_mode, render=False)
+    session_stats = pd.DataFrame(session_stats)
+    session_stats.insert(0, 'Date', date)
+    session_stats.insert(0, 'Sensor', sensor)
+    return session_stats
+
+
+def iter_work_units(file_paths, loader=load_sensor_file):
+    for file_path in file_paths:
+        sensor = sensor_name(file_path)
+        data = loader(file_path)
+        days = data['Date'].dt.normalize()
+        for day, day_data in data.groupby(days, sort=False):
+            yield sensor, day.date(), day_data
+
+
+def analyse_sensors(file_paths, occupancy_mode='Exact', max_workers=None,
+                    loader=load_sensor_file, pool=None):
+    """
+    input: list of sensor files and the occupancy mode
+    output: one DataFrame with the session stats of every sensor and day
+
+    Every (sensor, day) pair is an independent task for a process pool. The
+    results are merged in the order of the files and days, so the output does
+    not depend on the number of workers.
+    """
+    units = list(iter_work_units(file_paths, loader))
+    if not units:
+        return pd.DataFrame()
+    sensors, dates, frames = zip(*units)
+    modes = [occupancy_mode] * len(units)
+    # a few units per task keeps the pickling overhead low for short days
+    chunksize = max(1, len(units) // (4 * (max_workers or os.cpu_count())))
+
+    if pool is None:
+        with make_pool(max_workers) as own_pool:
+            results = list(own_pool.map(analyse_day, sensors, dates, frames,
+                                        modes, chunksize=chunksize))
+    else:
+        results = list(pool.map(analyse_day, sensors, dates, frames, modes,
+                                chunksize=chunksize))
+    return pd.concat(results, ignore_index=True)
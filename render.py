@@ -0,0 +1,95 @@
+import threading
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import matplotlib.dates as mdates
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from segmentation import group_sessions
+from sensor_store import time_window
+
+# one figure per thread, cleared and reused for every plot
+figures = threading.local()
+
+
+def get_figure():
+    """
+    output: a cleared Agg figure of 15x7 inch for the current thread
+
+    Plots are drawn on a plain Figure with an Agg canvas, so pyplot and its
+    figure manager are never involved.
+    """
+    figure = getattr(figures, 'figure', None)
+    if figure is None:
+        figure = Figure(figsize=(15, 7))
+        FigureCanvasAgg(figure)
+        figures.figure = figure
+    else:
+        figure.clear()
+    return figure
+
+
+def people_label(people, avg_count, occupancy_mode):
+    """
+    input: occupancy class and IQR average of a session, occupancy mode
+    output: the estimated number of people as shown in the legend
+    """
+    if occupancy_mode == 'Exact':
+        if people == 0:
+            return '1'
+        elif people > 4:
+            return '4+'
+        return str(int(people))
+    if avg_count < 153:
+        return '1-2'
+    return '3+'
+
+
+def plot_day(data, date, occupancy_mode, session_avgs, session_people):
+    """
+    input: segmented data, the day to plot, occupancy mode and the session
+    averages and classes from model.segment_day
+    output: png image of the sessions on that day as bytes
+    """
+    date = str(date).split()[0]
+    start_date = datetime.strptime(date, '%Y-%m-%d')
+    end_date = start_date + timedelta(days=1)
+    day_data = time_window(data, start_date, end_date)
+
+    figure = get_figure()
+    ax = figure.add_subplot()
+    ax.plot(np.array(day_data['Date']), np.array(day_data['Count']),
+            label='Noise', color='black', linewidth=1, alpha=0.5)
+
+    # rows grouped per session once, instead of a filter for every session
+    sessions = day_data['Session'].to_numpy()
+    order, ids, starts, sizes = group_sessions(sessions)
+    appearance = np.argsort(order[starts], kind='stable')
+    unique_sessions = ids[appearance]
+
+    for index, group in enumerate(appearance[1:]):
+        session = unique_sessions[index + 1]
+        session_data = day_data.iloc[
+            order[starts[group]:starts[group] + sizes[group]]]
+        people = people_label(session_people[session], session_avgs[session],
+                              occupancy_mode)
+        if people == '1':
+            label = f'Session {index + 1}: estimated {people} person'
+        else:
+            label = f'Session {index + 1}: estimated {people} people'
+
+        ax.plot(np.array(session_data['Date']),
+                np.array(session_data['Count']), label=label, linewidth=2,
+                alpha=0.5)
+
+    ax.set_title(f'Occupancy for the sessions on {date}')
+    ax.set_xlabel('Time of day')
+    ax.set_ylabel('Movement Count')
+    ax.legend()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    ax.tick_params(axis='x', labelrotation=45)
+    img_buf = BytesIO()
+    figure.savefig(img_buf, format='png')
+    return img_buf.getvalue()
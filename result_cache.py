@@ -0,0 +1,128 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from file_cache import evict
+
+
+def entry_size(value):
+    """
+    input: a cached value (bytes, str, DataFrame or a dict of those)
+    output: estimated size in bytes
+    """
+    if isinstance(value, dict):
+        return sum(entry_size(item) for item in value.values())
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    return 64
+
+
+class ResultCache:
+    """
+    In-process LRU cache for rendered plots, session stats and summaries.
+
+    Entries are evicted when the cache holds more than max_bytes or
+    max_entries. When disk_dir is given, entries are also pickled to disk and
+    a miss in memory is looked up there before it counts as a miss.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=1024,
+                 disk_dir=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def disk_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.disk_dir, f'{name}.pkl')
+
+    def get(self, key):
+        """
+        output: the cached value or None
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+        value = self.load_from_disk(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.store(key, value)
+        if self.disk_dir is not None:
+            self.save_to_disk(key, value)
+
+    def store(self, key, value):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        size = entry_size(value)
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.entries and (self.size > self.max_bytes or
+                                len(self.entries) > self.max_entries):
+            _, (_, old_size) = self.entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    def load_from_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self.disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored_key, value = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        # a different key with the same hash is treated as a miss
+        return value if stored_key == key else None
+
+    def save_to_disk(self, key, value):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = self.disk_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, value), f)
+        os.replace(tmp_path, path)
+        evict(self.disk_dir, self.max_disk_bytes, suffix='.pkl')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        output: dict with the hit/miss counters and the current size
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
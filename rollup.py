@@ -0,0 +1,323 @@
+"""
+Hourly, daily and monthly occupancy rollups per sensor.
+
+The rollups are built from the session stats of predict_occupancy_session
+(Start, End, People), not from the raw counts. Every sensor has one .npz
+cube with the same measures on three levels:
+
+- occupied_minutes: minutes inside a session, a session covers
+  [Start, End + 5 minutes), the last reading counts for its 5 minutes
+- sessions: number of sessions that started in the period
+- people_minutes: occupied minutes times the estimated people, divided by
+  occupied_minutes this is the time weighted mean number of people
+- open_minutes: opening time (8-24) of the processed days in the period
+
+The periods are numbered like numpy datetime64 values (hours, days and
+months since 1970), so a period number converts to a date with .astype().
+Updating a day replaces its hours and recomputes its day and month, queries
+only slice the stored arrays.
+
+    python rollup.py Data/TriggerCounts/Locus_sensors/*.xlsx
+"""
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+ROLLUP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '.cache', 'rollups')
+MEASURES = ('occupied_minutes', 'sessions', 'people_minutes', 'open_minutes')
+LEVELS = {'hour': 'h', 'day': 'D', 'month': 'M'}
+OPENING_HOUR = 8
+READING_MINUTES = 5
+
+# open minutes of every hour of a processed day
+OPEN_HOURS = np.where(np.arange(24) >= OPENING_HOUR, 60.0, 0.0)
+
+
+def people_number(people):
+    """
+    input: People column of the session stats ('1', '2', ... '4+')
+    output: float array, 4+ counts as 4
+    """
+    return np.array([float(str(value).rstrip('+')) for value in people])
+
+
+def day_number(date):
+    return int(np.datetime64(pd.Timestamp(date).date(), 'D').astype(np.int64))
+
+
+def hourly_rows(days, sessions):
+    """
+    input: list of day numbers and the session stats of those days (with a
+    Date column)
+    output: float64 array (days, 24, measures) with the hourly rollup
+    """
+    rows = np.zeros((len(days), 24, len(MEASURES)))
+    rows[:, :, MEASURES.index('open_minutes')] = OPEN_HOURS
+    if len(sessions) == 0:
+        return rows
+
+    position = {day: index for index, day in enumerate(days)}
+    day_of_session = np.array([position[day_number(date)]
+                               for date in sessions['Date']])
+    start = pd.to_datetime(sessions['Start']).to_numpy('datetime64[s]')
+    end = pd.to_datetime(sessions['End']).to_numpy('datetime64[s]')
+    midnight = start.astype('datetime64[D]').astype('datetime64[s]')
+    # minutes since the midnight of the day, sessions never cross midnight
+    first = (start - midnight).astype(np.int64) / 60
+    last = np.minimum((end - midnight).astype(np.int64) / 60 +
+                      READING_MINUTES, 24 * 60)
+
+    # overlap of every session with every hour of its day
+    hour_start = np.arange(24) * 60.0
+    overlap = np.clip(np.minimum(last[:, None], hour_start + 60) -
+                      np.maximum(first[:, None], hour_start), 0, None)
+    people = people_number(sessions['People'])
+
+    np.add.at(rows[:, :, MEASURES.index('occupied_minutes')],
+              day_of_session, overlap)
+    np.add.at(rows[:, :, MEASURES.index('people_minutes')],
+              day_of_session, overlap * people[:, None])
+    np.add.at(rows[:, :, MEASURES.index('sessions')],
+              (day_of_session, (first // 60).astype(np.int64)), 1)
+    return rows
+
+
+class SensorCube:
+    """
+    The rollup of one sensor: hourly, daily and monthly arrays of the
+    MEASURES, from the first to the last processed day (and its month).
+    """
+
+    def __init__(self, sensor, first_day=0, hourly=None, daily=None,
+                 first_month=0, monthly=None):
+        self.sensor = sensor
+        self.first_day = first_day
+        self.first_month = first_month
+        empty = np.zeros((0, len(MEASURES)), dtype=np.float32)
+        self.hourly = empty if hourly is None else hourly
+        self.daily = empty if daily is None else daily
+        self.monthly = empty if monthly is None else monthly
+
+    @classmethod
+    def load(cls, path, sensor):
+        with np.load(path) as cube:
+            return cls(sensor, int(cube['first_day']), cube['hourly'],
+                       cube['daily'], int(cube['first_month']),
+                       cube['monthly'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, first_day=self.first_day, hourly=self.hourly,
+                     daily=self.daily, first_month=self.first_month,
+                     monthly=self.monthly)
+        os.replace(tmp_path, path)
+
+    def first(self, level):
+        return {'hour': self.first_day * 24, 'day': self.first_day,
+                'month': self.first_month}[level]
+
+    def values(self, level):
+        return {'hour': self.hourly, 'day': self.daily,
+                'month': self.monthly}[level]
+
+    def grow(self, first_day, last_day):
+        """
+        Extends the arrays with zeros so they cover first_day..last_day
+        """
+        if len(self.daily):
+            first_day = min(first_day, self.first_day)
+            last_day = max(last_day, self.first_day + len(self.daily) - 1)
+        daily = np.zeros((last_day - first_day + 1, len(MEASURES)),
+                         dtype=np.float32)
+        hourly = np.zeros((len(daily) * 24, len(MEASURES)), dtype=np.float32)
+        if len(self.daily):
+            offset = self.first_day - first_day
+            daily[offset:offset + len(self.daily)] = self.daily
+            hourly[offset * 24:(offset + len(self.daily)) * 24] = self.hourly
+        self.first_day, self.daily, self.hourly = first_day, daily, hourly
+
+    def update_days(self, days, sessions):
+        """
+        input: the dates that were (re)processed and their session stats
+        Replaces the hours and days of those dates and recomputes the months.
+        """
+        days = sorted({day_number(date) for date in days})
+        if not days:
+            return
+        rows = hourly_rows(days, sessions)
+        self.grow(days[0], days[-1])
+        index = np.array(days) - self.first_day
+        self.hourly.reshape(-1, 24, len(MEASURES))[index] = rows
+        self.daily[index] = rows.sum(axis=1)
+
+        # months are summed from the days again, a few years of days is tiny
+        months = (np.arange(len(self.daily)) + self.first_day).astype(
+            'datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        starts = np.flatnonzero(np.concatenate(([True],
+                                                months[1:] != months[:-1])))
+        self.first_month = int(months[0])
+        self.monthly = np.add.reduceat(self.daily.astype(np.float64), starts,
+                                       axis=0).astype(np.float32)
+
+    def window(self, level, start=None, end=None):
+        """
+        input: 'hour', 'day' or 'month' and optionally a [start, end) window
+        output: (period numbers, float32 array of the MEASURES) in the window
+        """
+        unit = LEVELS[level]
+        values = self.values(level)
+        first = self.first(level)
+        lo, hi = 0, len(values)
+        if start is not None:
+            lo = max(lo, period_number(start, unit) - first)
+        if end is not None:
+            hi = min(hi, period_number(end, unit) - first)
+        hi = max(lo, hi)
+        return np.arange(lo, hi) + first, values[lo:hi]
+
+    def frame(self, level, start=None, end=None):
+        """
+        output: rollup_frame of the window
+        """
+        periods, values = self.window(level, start, end)
+        return rollup_frame(level, periods, values)
+
+
+def rollup_frame(level, periods, values, **columns):
+    """
+    input: level, period numbers, array of the MEASURES and extra columns
+    to put in front
+    output: DataFrame with Period, Occupied_Minutes, Sessions, Mean_People
+    and Utilisation (% of the opening time)
+    """
+    values = values.astype(np.float64)
+    occupied = values[:, MEASURES.index('occupied_minutes')]
+    open_minutes = values[:, MEASURES.index('open_minutes')]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_people = values[:, MEASURES.index('people_minutes')] / occupied
+        utilisation = 100 * occupied / open_minutes
+    return pd.DataFrame(dict(
+        columns,
+        Period=periods.astype(f'datetime64[{LEVELS[level]}]').astype(
+            'datetime64[ns]'),
+        Occupied_Minutes=occupied,
+        Sessions=values[:, MEASURES.index('sessions')].astype(np.int64),
+        Mean_People=mean_people,
+        Utilisation=utilisation,
+    ))
+
+
+def period_number(date, unit):
+    return int(np.datetime64(pd.Timestamp(date).to_datetime64(), unit).astype(
+        np.int64))
+
+
+class RollupStore:
+    """
+    The cubes of all sensors in a directory, loaded cubes are kept in memory
+    until their file changes.
+    """
+
+    def __init__(self, rollup_dir=ROLLUP_DIR):
+        self.rollup_dir = rollup_dir
+        self.cubes = {}
+        self.lock = threading.Lock()
+
+    def path(self, sensor):
+        """
+        output: path of the cube file of the sensor, a name that could point
+        outside rollup_dir (like ../x, comes from ?sensor= of /rollups)
+        raises a ValueError
+        """
+        if sensor in ('', '.', '..') or any(
+                character in sensor for character in ('/', '\\', '\0')):
+            raise ValueError(f'Invalid sensor name {sensor!r}')
+        return os.path.join(self.rollup_dir, f'{sensor}.npz')
+
+    def sensors(self):
+        if not os.path.isdir(self.rollup_dir):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.rollup_dir)
+                      if name.endswith('.npz'))
+
+    def cube(self, sensor):
+        """
+        output: the SensorCube of the sensor, empty when it has none yet
+        """
+        path = self.path(sensor)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return SensorCube(sensor)
+        with self.lock:
+            cached = self.cubes.get(sensor)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        cube = SensorCube.load(path, sensor)
+        with self.lock:
+            self.cubes[sensor] = (mtime, cube)
+        return cube
+
+    def update(self, sensor, days, sessions):
+        """
+        input: sensor name, the dates that were (re)processed and their
+        session stats with a Date column, e.g. from IncrementalProcessor
+        """
+        with self.lock:
+            cached = self.cubes.pop(sensor, None)
+        cube = cached[1] if cached is not None else self.cube(sensor)
+        cube.update_days(days, sessions)
+        cube.save(self.path(sensor))
+        with self.lock:
+            self.cubes[sensor] = (os.stat(self.path(sensor)).st_mtime_ns,
+                                  cube)
+        return cube
+
+    def query(self, level, start=None, end=None, sensors=None):
+        """
+        input: 'hour', 'day' or 'month', optionally a [start, end) window and
+        the sensors (all by default)
+        output: DataFrame with a Sensor column and the columns of
+        SensorCube.frame, one row per sensor and period
+        """
+        if level not in LEVELS:
+            raise ValueError(f'level should be one of {", ".join(LEVELS)}')
+        sensors = list(sensors if sensors is not None else self.sensors())
+        codes, periods, values = [np.zeros(0, dtype=np.int32)], [
+            np.zeros(0, dtype=np.int64)], [np.zeros((0, len(MEASURES)))]
+        for code, sensor in enumerate(sensors):
+            sensor_periods, sensor_values = self.cube(sensor).window(
+                level, start, end)
+            codes.append(np.full(len(sensor_periods), code, dtype=np.int32))
+            periods.append(sensor_periods)
+            values.append(sensor_values)
+        # a categorical Sensor column, repeating the names is slow for hours
+        return rollup_frame(level, np.concatenate(periods),
+                            np.concatenate(values),
+                            Sensor=pd.Categorical.from_codes(
+                                np.concatenate(codes), categories=sensors))
+
+
+def update_from_files(file_paths, store=None, occupancy_mode='Exact'):
+    """
+    input: list of (growing) sensor exports
+    output: the RollupStore, updated with the days that changed
+    """
+    from incremental import update_from_file
+
+    store = store or RollupStore()
+    for file_path in file_paths:
+        update_from_file(file_path, occupancy_mode=occupancy_mode,
+                         rollup=store)
+    return store
+
+
+if __name__ == '__main__':
+    store = update_from_files(sys.argv[1:])
+    print(store.query('month'))
@@ -0,0 +1,294 @@
+import numpy as np
+
+# default segmentation parameters, these are the values the model was tuned on
+SESSION_START = 0
+SESSION_STOP = 5
+MIN_SESSION_POINTS = 6
+SPLIT_WINDOW = 25
+SPLIT_MIN_PERIODS = 20
+CHANGE_THRESHOLD = 10
+# splits per session, None splits at every change (1 is the old behaviour)
+MAX_SPLITS = None
+
+
+def default_params():
+    """
+    output: dict with the current segmentation parameters, in the order of the
+    segment_sessions arguments
+    """
+    return {
+        'start': SESSION_START,
+        'stop': SESSION_STOP,
+        'min_points': MIN_SESSION_POINTS,
+        'window': SPLIT_WINDOW,
+        'min_periods': SPLIT_MIN_PERIODS,
+        'change_threshold': CHANGE_THRESHOLD,
+        'max_splits': MAX_SPLITS,
+    }
+
+
+def label_sessions(counts, start=SESSION_START, stop=SESSION_STOP):
+    """
+    input: array of movement counts, sorted on time
+    output: int64 array of session labels (0 means no session)
+
+    Vectorized version of the start/stop state machine. A session starts at a
+    count above `start` and ends (inclusive) at the first count below `stop`.
+    NaN counts neither start nor end a session.
+    """
+    counts = np.asarray(counts, dtype=float)
+    if len(counts) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # the session state after each row: off below `stop`, on when the count
+    # could also start a session, carried over from the previous row otherwise
+    state = np.full(len(counts), -1, dtype=np.int8)
+    state[counts < stop] = 0
+    state[(counts >= stop) & (counts > start)] = 1
+    known = np.where(state >= 0, np.arange(len(counts)), -1)
+    np.maximum.accumulate(known, out=known)
+    in_after = np.where(known >= 0, state[np.maximum(known, 0)] == 1, False)
+
+    in_before = np.empty_like(in_after)
+    in_before[0] = False
+    in_before[1:] = in_after[:-1]
+
+    labelled = in_before | (counts > start)
+    starts = labelled & ~in_before
+    return np.where(labelled, np.cumsum(starts), 0).astype(np.int64)
+
+
+def filter_short_sessions(labels, min_points=MIN_SESSION_POINTS):
+    """
+    input: array of session labels
+    output: copy of the labels where sessions shorter than min_points are 0
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if len(labels) == 0:
+        return labels.copy()
+    sizes = np.bincount(labels)
+    return np.where(sizes[labels] >= min_points, labels, 0)
+
+
+def session_bounds(labels):
+    """
+    input: array of session labels
+    output: (starts, ends, values) of every run of equal labels, ends exclusive
+
+    Run-length encoding of the labels, sessions are always contiguous runs.
+    """
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, labels[:0]
+    change = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(labels)]))
+    return starts, ends, labels[starts]
+
+
+def rolling_mean_within_runs(counts, run_starts, window=SPLIT_WINDOW,
+                             min_periods=SPLIT_MIN_PERIODS):
+    """
+    input: counts and the start index of the run every row belongs to
+    output: rolling mean that restarts at every run, NaN below min_periods
+
+    Gives the same values as pandas .rolling(window, min_periods).mean()
+    applied to every run separately.
+    """
+    counts = np.asarray(counts, dtype=float)
+    valid = ~np.isnan(counts)
+    value_sum = np.concatenate(([0.0], np.cumsum(np.where(valid, counts, 0))))
+    valid_sum = np.concatenate(([0], np.cumsum(valid)))
+
+    position = np.arange(len(counts))
+    window_start = np.maximum(position - window + 1, run_starts)
+    total = value_sum[position + 1] - value_sum[window_start]
+    nobs = valid_sum[position + 1] - valid_sum[window_start]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / nobs
+    mean[nobs < max(min_periods, 1)] = np.nan
+    return mean
+
+
+def rolling_changes(counts, labels, window=SPLIT_WINDOW,
+                    min_periods=SPLIT_MIN_PERIODS):
+    """
+    input: counts and (filtered) session labels
+    output: float array with the absolute change of the rolling average
+    compared to the previous row, NaN at the first row of every run and
+    outside sessions
+
+    The part of the first split round of split_sessions_on_changes that
+    doesn't depend on the threshold, a parameter sweep computes it once for
+    all thresholds.
+    """
+    counts = np.asarray(counts, dtype=float)
+    labels = np.asarray(labels, dtype=np.int64)
+    change = np.full(len(labels), np.nan)
+    if len(labels) == 0:
+        return change
+
+    starts, ends, values = session_bounds(labels)
+    run_starts = np.repeat(starts, ends - starts)
+    rolling_avg = rolling_mean_within_runs(counts, run_starts, window,
+                                           min_periods)
+    change[1:] = np.abs(np.diff(rolling_avg))
+    # the first row of a run has no previous average to compare with
+    change[starts] = np.nan
+    change[labels == 0] = np.nan
+    return change
+
+
+def first_jumps(starts, change, change_threshold=CHANGE_THRESHOLD):
+    """
+    input: start rows of the runs of labels (from session_bounds) and the
+    rolling_changes of the labels
+    output: (rows, runs) of the first change above change_threshold in every
+    run that has one
+    """
+    with np.errstate(invalid='ignore'):
+        jumps = np.flatnonzero(change > change_threshold)
+    runs = np.searchsorted(starts, jumps, side='right') - 1
+    first = np.concatenate(([True], runs[1:] != runs[:-1]))[:len(runs)]
+    return jumps[first], runs[first]
+
+
+def concatenated_ranges(starts, stops):
+    """
+    output: the rows of all [start, stop) ranges after each other
+    """
+    lengths = stops - starts
+    offsets = np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+    return np.arange(lengths.sum()) - offsets
+
+
+def split_sessions_on_changes(counts, labels, window=SPLIT_WINDOW,
+                              min_periods=SPLIT_MIN_PERIODS,
+                              change_threshold=CHANGE_THRESHOLD,
+                              max_splits=MAX_SPLITS, change=None):
+    """
+    input: counts, (filtered) session labels, the split parameters and
+    optionally the rolling_changes of the labels when they are known already
+    output: new labels where sessions are split at every jump in rolling
+    average
+
+    A session is split at the first row where the rolling average moves more
+    than change_threshold compared to the previous row, the part after the
+    jump gets a new id (counting up from the highest id) and is searched
+    again like a new session, with a rolling average that starts at the
+    jump. max_splits limits the splits per session, 1 gives the old single
+    split.
+
+    Every round looks a bit further into the open parts of all sessions at
+    once, `lookahead` rows past their start, doubled for the parts without a
+    jump in it. So every row is looked at a few times at most, however many
+    splits a session has.
+    """
+    counts = np.asarray(counts, dtype=float)
+    labels = np.asarray(labels, dtype=np.int64)
+    if change is None:
+        change = rolling_changes(counts, labels, window, min_periods)
+    starts, ends, _ = session_bounds(labels)
+    rows, runs = first_jumps(starts, change, change_threshold)
+    if len(rows) == 0:
+        return labels.copy()
+    split_rows = [rows]
+
+    # the open parts: the rows after a split that aren't searched yet
+    first_lookahead = 4 * max(window, min_periods, 1)
+    part_start, part_end = rows, ends[runs]
+    splits = np.ones(len(rows), dtype=np.int64)
+    lookahead = np.full(len(rows), first_lookahead)
+    if max_splits is not None:
+        keep = splits < max_splits
+        part_start, part_end = part_start[keep], part_end[keep]
+        splits, lookahead = splits[keep], lookahead[keep]
+    while len(part_start):
+        stop = np.minimum(part_start + lookahead, part_end)
+        index = concatenated_ranges(part_start, stop)
+        # every part gets its own label, so the rolling average restarts at
+        # the start of the part
+        lengths = stop - part_start
+        part_labels = np.repeat(np.arange(1, len(part_start) + 1), lengths)
+        change = rolling_changes(counts[index], part_labels, window,
+                                 min_periods)
+        rows, parts = first_jumps(np.cumsum(lengths) - lengths, change,
+                                  change_threshold)
+        rows = index[rows]
+        split_rows.append(rows)
+
+        found = np.zeros(len(part_start), dtype=bool)
+        found[parts] = True
+        further = ~found & (stop < part_end)
+        split = splits[parts] + 1
+        keep = np.ones(len(parts), dtype=bool) if max_splits is None else \
+            split < max_splits
+        part_start = np.concatenate((part_start[further], rows[keep]))
+        part_end = np.concatenate((part_end[further], part_end[parts][keep]))
+        splits = np.concatenate((splits[further], split[keep]))
+        lookahead = np.concatenate((lookahead[further] * 2, np.full(
+            keep.sum(), first_lookahead)))
+
+    # every split gives the rest of its session the next new id
+    mark = np.zeros(len(labels), dtype=np.int64)
+    mark[np.concatenate(split_rows)] = 1
+    split_number = np.cumsum(mark)
+    run_start = np.repeat(starts, ends - starts)
+    return np.where(split_number > split_number[run_start],
+                    labels.max() + split_number, labels)
+
+
+def segment_sessions(counts, start=SESSION_START, stop=SESSION_STOP,
+                     min_points=MIN_SESSION_POINTS, window=SPLIT_WINDOW,
+                     min_periods=SPLIT_MIN_PERIODS,
+                     change_threshold=CHANGE_THRESHOLD,
+                     max_splits=MAX_SPLITS):
+    """
+    input: array of movement counts, sorted on time
+    output: int64 array of session labels (0 means no session)
+
+    The full segmentation: label sessions, drop the short ones, split on
+    changes in the rolling average and drop the short ones again.
+    """
+    labels = label_sessions(counts, start, stop)
+    labels = filter_short_sessions(labels, min_points)
+    labels = split_sessions_on_changes(counts, labels, window, min_periods,
+                                       change_threshold, max_splits)
+    return filter_short_sessions(labels, min_points)
+
+
+def group_sessions(sessions):
+    """
+    input: array of session ids
+    output: (order, ids, starts, sizes) where order sorts the rows by session
+    (stable, so rows keep their time order) and ids[i] is the session of the
+    rows order[starts[i]:starts[i] + sizes[i]]
+    """
+    order = np.argsort(sessions, kind='stable')
+    ids, starts, sizes = np.unique(sessions[order], return_index=True,
+                                   return_counts=True)
+    return order, ids, starts, sizes
+
+
+def find_low_count_peaks(counts, threshold=0, num_points=1, offset=0):
+    """
+    input: array of counts, threshold, number of preceding points and offset
+    output: int64 array with the positions of the valid peaks
+
+    A peak is a count above threshold + offset that directly follows
+    num_points counts at or below the threshold. Same result as calling
+    surrounded_by_low_counts for every index, using a running sum of the low
+    points instead of a slice per index.
+    """
+    counts = np.asarray(counts, dtype=float)
+    position = np.arange(len(counts))
+    if num_points < 0:
+        return position[:0]
+
+    low = np.concatenate(([0], np.cumsum(counts <= threshold)))
+    window_start = np.maximum(position - num_points, 0)
+    preceded_by_low = (position >= num_points) & (
+        low[position] - low[window_start] == num_points)
+    return np.flatnonzero(preceded_by_low & (counts > threshold + offset))
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from compact import CompactFrame
+
+
+def to_datetime64(value):
+    return np.datetime64(pd.Timestamp(value).to_datetime64(), 'ns')
+
+
+class SensorSeries:
+    """
+    The sorted readings of one sensor as datetime64[ns] and float64 arrays,
+    with an index of the first row of every day.
+
+    Windows of a series are slices of the same arrays, so they are views and
+    don't copy any data.
+    """
+
+    def __init__(self, dates, counts, sort=True):
+        dates = np.asarray(dates, dtype='datetime64[ns]')
+        counts = np.asarray(counts, dtype=float)
+        if sort and len(dates) and np.any(dates[1:] < dates[:-1]):
+            order = np.argsort(dates, kind='stable')
+            dates, counts = dates[order], counts[order]
+        self.dates = dates
+        self.counts = counts
+        days = dates.astype('datetime64[D]')
+        change = np.flatnonzero(days[1:] != days[:-1]) + 1
+        self.day_offsets = np.concatenate(([0], change)) if len(days) else \
+            np.zeros(0, dtype=np.int64)
+        self.days = days[self.day_offsets]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def window(self, start, end, closed='left'):
+        """
+        input: start and end time, closed is 'left' for [start, end) and
+        'both' for [start, end]
+        output: SensorSeries view with the readings in the window
+        """
+        first = np.searchsorted(self.dates, to_datetime64(start), side='left')
+        side = 'right' if closed == 'both' else 'left'
+        last = np.searchsorted(self.dates, to_datetime64(end), side=side)
+        return self.slice(first, max(first, last))
+
+    def day(self, date):
+        """
+        input: a date
+        output: SensorSeries view with the readings of that day
+        """
+        day = np.datetime64(pd.Timestamp(date).date(), 'D')
+        index = np.searchsorted(self.days, day)
+        if index == len(self.days) or self.days[index] != day:
+            return self.slice(0, 0)
+        end = self.day_offsets[index + 1] if index + 1 < len(self.days) \
+            else len(self.dates)
+        return self.slice(self.day_offsets[index], end)
+
+    def slice(self, first, last):
+        return SensorSeries(self.dates[first:last], self.counts[first:last],
+                            sort=False)
+
+    def to_frame(self):
+        """
+        output: DataFrame with Date and Count columns, like model.preprocess
+        """
+        return pd.DataFrame({'Date': self.dates, 'Count': self.counts})
+
+
+class SensorStore:
+    """
+    Sorted series of many sensors, answers (sensor, start, end) queries with a
+    binary search instead of a mask over all rows.
+    """
+
+    def __init__(self):
+        self.series = {}
+
+    def add(self, sensor, data):
+        """
+        input: sensor name and a DataFrame with Date and Count columns
+        """
+        data = data.dropna(subset=['Date'])
+        self.series[sensor] = SensorSeries(data['Date'].to_numpy(),
+                                           data['Count'].to_numpy())
+
+    @classmethod
+    def from_files(cls, file_paths):
+        """
+        input: list of sensor files (raw exports or cleaned files)
+        output: SensorStore with a series for every file
+        """
+        from parallel import load_sensor_file, sensor_name
+
+        store = cls()
+        for file_path in file_paths:
+            store.add(sensor_name(file_path), load_sensor_file(file_path))
+        return store
+
+    def sensors(self):
+        return list(self.series)
+
+    def __getitem__(self, sensor):
+        return self.series[sensor]
+
+    def query(self, sensor, start, end, closed='left'):
+        return self.series[sensor].window(start, end, closed)
+
+    def day(self, sensor, date):
+        return self.series[sensor].day(date)
+
+
+def time_window(data, start, end, closed='left'):
+    """
+    input: DataFrame with a Date column, SensorSeries or CompactFrame, start
+    and end time, closed is 'left' for [start, end) and 'both' for
+    [start, end]
+    output: the rows in the window, as the same type as the input
+
+    Sorted frames are sliced with a binary search, other frames fall back to a
+    boolean mask.
+    """
+    if isinstance(data, (SensorSeries, CompactFrame)):
+        return data.window(start, end, closed)
+
+    dates = data['Date']
+    if dates.is_monotonic_increasing:
+        first = dates.searchsorted(pd.Timestamp(start), side='left')
+        side = 'right' if closed == 'both' else 'left'
+        last = dates.searchsorted(pd.Timestamp(end), side=side)
+        return data.iloc[first:max(first, last)]
+
+    if closed == 'both':
+        return data.loc[(dates >= start) & (dates <= end)]
+    return data.loc[(dates >= start) & (dates < end)]
+
+
+def day_window(data, date):
+    """
+    input: DataFrame with a Date column, SensorSeries or CompactFrame and a
+    date
+    output: the rows of that day
+    """
+    if isinstance(data, (SensorSeries, CompactFrame)):
+        return data.day(date)
+    start = pd.Timestamp(date).normalize()
+    return time_window(data, start, start + pd.Timedelta(days=1))
+
+
+def as_frame(data):
+    """
+    output: the data as a DataFrame with Date and Count columns, lets the
+    helpers that work on frames also take a SensorSeries or CompactFrame
+    """
+    if isinstance(data, (SensorSeries, CompactFrame)):
+        return data.to_frame()
+    return data
@@ -0,0 +1,228 @@
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 10000
+# the header is searched for in the first rows of an export
+HEADER_SEARCH_ROWS = 20
+# merged room files have a Count_<sensor> column per sensor
+COUNT_PREFIX = 'Count_'
+
+
+def count_columns(names, count_column=None):
+    """
+    input: names of a header row and the count column, None to detect it
+    output: list with the count columns in the header, empty when there are
+    none
+
+    Without a count_column that is Count, or else all Count_<sensor> columns
+    of a merged room file like Data/Projectroom/merged_sensors_data.xlsx.
+    """
+    if count_column is not None:
+        return [count_column] if count_column in names else []
+    if 'Count' in names:
+        return ['Count']
+    return [name for name in names if name.startswith(COUNT_PREFIX)]
+
+
+def find_header(rows, date_column='Date', count_column='Count'):
+    """
+    input: iterator over the rows of an export
+    output: (number of rows before the header, header row)
+
+    Raw exports start with a title and white lines before the header, the
+    cleaned files start with the header directly. count_column=None also
+    accepts the Count_<sensor> columns of merged files.
+    """
+    for index, row in enumerate(rows):
+        if index >= HEADER_SEARCH_ROWS:
+            break
+        names = ['' if value is None else str(value).strip() for value in row]
+        if date_column in names and count_columns(names, count_column):
+            return index, names
+    raise ValueError(f"No header with '{date_column}' and "
+                     f"'{count_column or 'Count'}' found in the first "
+                     f"{HEADER_SEARCH_ROWS} rows")
+
+
+def to_numbers(values):
+    return pd.to_numeric(pd.Series(values, dtype=object),
+                         errors='coerce').to_numpy(dtype=float)
+
+
+def to_chunk(dates, counts):
+    """
+    input: list of raw date values and a list of raw count values per count
+    column
+    output: (datetime64[ns] array, float64 array), unparseable values become
+    NaT/NaN. Several count columns are summed like fusion.combine does, NaN
+    where none of them has a count.
+    """
+    dates = pd.to_datetime(pd.Series(dates, dtype=object), errors='coerce')
+    columns = np.vstack([to_numbers(values) for values in counts])
+    if len(columns) == 1:
+        total = columns[0]
+    else:
+        total = np.nansum(columns, axis=0)
+        total[np.isnan(columns).all(axis=0)] = np.nan
+    return dates.to_numpy(dtype='datetime64[ns]'), total
+
+
+def iter_excel_chunks(file_path, chunk_size=CHUNK_SIZE, date_column='Date',
+                      count_column=None):
+    """
+    input: path of an xlsx export, the count column is detected when it is
+    None (see count_columns)
+    output: generator of (timestamps, counts) chunks of at most chunk_size rows
+
+    Reads the workbook in openpyxl read-only mode, so only one chunk of rows
+    is in memory at a time.
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True,
+                                      data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        _, header = find_header(rows, date_column, count_column)
+        date_index = header.index(date_column)
+        count_indexes = [header.index(name)
+                         for name in count_columns(header, count_column)]
+        width = max(date_index, *count_indexes)
+
+        dates, counts = [], [[] for _ in count_indexes]
+        for row in rows:
+            if len(row) <= width:
+                continue
+            dates.append(row[date_index])
+            for values, index in zip(counts, count_indexes):
+                values.append(row[index])
+            if len(dates) == chunk_size:
+                yield to_chunk(dates, counts)
+                dates, counts = [], [[] for _ in count_indexes]
+        if dates:
+            yield to_chunk(dates, counts)
+    finally:
+        workbook.close()
+
+
+def iter_csv_chunks(file_path, chunk_size=CHUNK_SIZE, date_column='Date',
+                    count_column=None):
+    """
+    input: path of a csv export, like the files in processed/, the count
+    column is detected when it is None (see count_columns)
+    output: generator of (timestamps, counts) chunks of at most chunk_size rows
+    """
+    with open(file_path, newline='') as f:
+        skiprows, header = find_header(csv.reader(f), date_column,
+                                       count_column)
+    columns = count_columns(header, count_column)
+
+    reader = pd.read_csv(file_path, skiprows=skiprows,
+                         usecols=[date_column] + columns,
+                         chunksize=chunk_size)
+    for chunk in reader:
+        yield to_chunk(chunk[date_column].tolist(),
+                       [chunk[column].tolist() for column in columns])
+
+
+def iter_chunks(file_path, chunk_size=CHUNK_SIZE, date_column='Date',
+                count_column=None):
+    """
+    input: path of an xlsx or csv export, a single sensor or a merged room
+    file (its Count_<sensor> columns are summed)
+    output: generator of (timestamps, counts) chunks
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.csv':
+        return iter_csv_chunks(file_path, chunk_size, date_column,
+                               count_column)
+    if extension in ('.xlsx', '.xlsm'):
+        return iter_excel_chunks(file_path, chunk_size, date_column,
+                                 count_column)
+    raise ValueError(f'Cannot stream {extension} files, use xlsx or csv')
+
+
+def read_header(file_path, date_column='Date', count_column=None):
+    """
+    input: path of an xlsx or csv export
+    output: the header row, without reading the rest of the file
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.csv':
+        with open(file_path, newline='') as f:
+            return find_header(csv.reader(f), date_column, count_column)[1]
+    if extension not in ('.xlsx', '.xlsm'):
+        raise ValueError(f'Cannot stream {extension} files, use xlsx or csv')
+
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True,
+                                      data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        return find_header(rows, date_column, count_column)[1]
+    finally:
+        workbook.close()
+
+
+def is_merged(file_path):
+    """
+    output: True for a merged room file with Count_<sensor> columns instead
+    of a single Count column
+    """
+    return count_columns(read_header(file_path)) != ['Count']
+
+
+def clean_chunk(dates, counts):
+    """
+    Same cleaning as model.preprocess: drops missing dates and closed hours.
+    """
+    keep = ~np.isnat(dates)
+    hours = (dates - dates.astype('datetime64[D]')).astype('timedelta64[h]')
+    keep &= hours.astype(np.int64) >= 8
+    return dates[keep], counts[keep]
+
+
+def iter_day_frames(chunks):
+    """
+    input: iterator of (timestamps, counts) chunks in chronological order
+    output: generator of (date, DataFrame with Date and Count) for every day
+
+    Rows are buffered until the day changes, so at most one day plus one chunk
+    is in memory. Exports are written in chronological order, a day that shows
+    up again after a later day raises a ValueError.
+    """
+    current_day = None
+    buffered = []
+    finished = set()
+
+    def day_frame():
+        dates = np.concatenate([d for d, _ in buffered])
+        counts = np.concatenate([c for _, c in buffered])
+        return pd.DataFrame({'Date': dates, 'Count': counts})
+
+    for dates, counts in chunks:
+        dates, counts = clean_chunk(dates, counts)
+        days = dates.astype('datetime64[D]')
+        # positions where the day changes inside this chunk
+        change = np.flatnonzero(days[1:] != days[:-1]) + 1
+        starts = np.concatenate(([0], change)) if len(days) else []
+        ends = np.concatenate((change, [len(days)])) if len(days) else []
+        for start, end in zip(starts, ends):
+            day = days[start]
+            if day != current_day:
+                if current_day is not None:
+                    finished.add(current_day)
+                    yield pd.Timestamp(current_day).date(), day_frame()
+                if day in finished:
+                    raise ValueError(f'Rows for {day} are not in '
+                                     f'chronological order')
+                current_day = day
+                buffered = []
+            buffered.append((dates[start:end], counts[start:end]))
+
+    if current_day is not None:
+        yield pd.Timestamp(current_day).date(), day_frame()
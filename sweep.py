@@ -0,0 +1,319 @@
+"""
+Parameter sweep of the segmentation against the ground truth.
+
+Every parameter set (the segment_sessions parameters and the cut-off of the
+grouped mode) is scored on the labelled data in Data_target and Data_clean:
+the sessions are segmented and classified like predict_occupancy_session
+does, every reading gets the people of its session (0 outside sessions) and
+is compared with the counted people.
+
+The grid is evaluated as a tree: the labels of a start/stop pair, the
+filtered labels of a min_points value and the rolling averages of a
+window/min_periods pair are computed once and shared by all the change
+thresholds, split limits and cut-offs below them. The subtrees run in the
+process pool.
+
+    python sweep.py --workers 8 --output sweep.csv
+    python sweep.py --change-threshold 5 10 15 20 --window 25
+    python sweep.py --max-splits 1 0        (0 means no limit)
+"""
+import argparse
+import itertools
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from segmentation import (default_params, filter_short_sessions,
+                          label_sessions, rolling_changes,
+                          split_sessions_on_changes)
+
+# mean count above which the grouped mode says 3+ people, as in the
+# interface and the plots
+GROUPED_CUTOFF = 153
+PARAMS = tuple(default_params()) + ('grouped_cutoff',)
+# (name, path, count column, people column), files without a Date column
+# are one continuous series of readings. Data_clean/countsvspeople.xlsx is
+# left out, it is the first 121 rows of counts_locus.xlsx.
+GROUND_TRUTH = (
+    ('projectroom', 'Data_target/merged_sensors_data_modified.xlsx',
+     'Count_2P02', 'occupancy'),
+    ('counts_locus', 'Data_target/counts_locus.xlsx', 'Count', 'People'),
+    ('counts_alta', 'Data_target/counts_alta.xlsx', 'counts', 'people'),
+)
+# the classifier knows at most 4 people, readings with more counted people
+# (counts_alta goes up to 5) only count for the occupied and grouped scores
+MAX_PEOPLE = 4
+
+
+class GroundTruth:
+    """
+    Labelled readings of one file, split into days like the pipeline does:
+    a list of (counts, people) array pairs.
+    """
+
+    def __init__(self, name, days):
+        self.name = name
+        self.days = days
+
+    @property
+    def rows(self):
+        return sum(len(counts) for counts, _ in self.days)
+
+    @property
+    def exact_rows(self):
+        """
+        output: the readings the exact score is computed on, those with at
+        most MAX_PEOPLE counted people
+        """
+        return sum(int(np.sum(people <= MAX_PEOPLE))
+                   for _, people in self.days)
+
+
+def load_ground_truth(name, path, count_column, people_column):
+    data = pd.read_excel(path)
+    if 'Date' not in data.columns:
+        return GroundTruth(name, [(data[count_column].to_numpy(dtype=float),
+                                   data[people_column].to_numpy())])
+
+    data = data.dropna(subset=['Date'])
+    data = data[data['Date'].dt.hour.between(8, 24)].sort_values('Date')
+    days = [(day_data[count_column].to_numpy(dtype=float),
+             day_data[people_column].to_numpy())
+            for _, day_data in data.groupby(data['Date'].dt.date)]
+    return GroundTruth(name, days)
+
+
+def load_all(ground_truth=GROUND_TRUTH):
+    """
+    output: list of GroundTruth, files that don't exist are skipped
+    """
+    return [load_ground_truth(*source) for source in ground_truth
+            if os.path.exists(source[1])]
+
+
+def default_grid():
+    """
+    output: dict parameter -> values around the current defaults
+    """
+    return {
+        'start': [0, 1, 2],
+        'stop': [3, 5, 8],
+        'min_points': [4, 6, 8],
+        'window': [15, 25, 35],
+        'min_periods': [10, 20],
+        'change_threshold': [5, 10, 15, 20],
+        'max_splits': [1, None],
+        'grouped_cutoff': [120, GROUPED_CUTOFF, 180],
+    }
+
+
+def parameter_sets(grid):
+    """
+    input: dict parameter -> list of values, missing parameters keep their
+    default
+    output: list of parameter dicts, without the sets where min_periods is
+    larger than the window
+    """
+    defaults = dict(default_params(), grouped_cutoff=GROUPED_CUTOFF)
+    values = [grid.get(param, [defaults[param]]) for param in PARAMS]
+    return [dict(zip(PARAMS, combination))
+            for combination in itertools.product(*values)
+            if combination[PARAMS.index('min_periods')] <=
+            combination[PARAMS.index('window')]]
+
+
+def session_predictions(counts, labels):
+    """
+    input: counts and session labels of a day
+    output: (people, mean count) of the session of every row, 0 and NaN
+    outside sessions
+    """
+    from model import find_nearest_occupancies, session_stats_table
+
+    people = np.zeros(len(labels))
+    means = np.full(len(labels), np.nan)
+    if not labels.any():
+        return people, means
+    # only the count stats are used, the dates are one reading per 5 minutes
+    dates = np.arange(len(labels)) * np.timedelta64(5, 'm') + \
+        np.datetime64('2024-01-01')
+    table = session_stats_table(labels, counts, dates)
+    table = table[table.index != 0].sort_index()
+    session_people = np.asarray(find_nearest_occupancies(table['IQR_Mean']),
+                                dtype=float)
+    inside = labels != 0
+    position = np.searchsorted(table.index.to_numpy(), labels[inside])
+    # people_class shows 0 people as 1
+    people[inside] = np.maximum(session_people[position], 1)
+    means[inside] = table['Mean'].to_numpy()[position]
+    return people, means
+
+
+def score(truth, people, means, grouped_cutoffs):
+    """
+    input: counted and predicted people and the mean count of the session
+    of every reading, list of grouped cut-offs
+    output: (exact hits, occupied hits, grouped hits per cut-off), readings
+    with more than MAX_PEOPLE people are never an exact hit and aren't
+    counted in GroundTruth.exact_rows
+    """
+    exact = int(np.sum((people == truth) & (truth <= MAX_PEOPLE)))
+    occupied = int(np.sum((people > 0) == (truth > 0)))
+    truth_group = np.where(truth == 0, 0, np.where(truth <= 2, 1, 2))
+    grouped = []
+    for cutoff in grouped_cutoffs:
+        with np.errstate(invalid='ignore'):
+            group = np.where(people == 0, 0, np.where(means < cutoff, 1, 2))
+        grouped.append(int(np.sum(group == truth_group)))
+    return exact, occupied, grouped
+
+
+def evaluate_subtree(datasets, start, stop, min_points, window, min_periods,
+                     change_thresholds, max_splits, grouped_cutoffs):
+    """
+    Work unit of the sweep: all change thresholds, split limits and cut-offs
+    below one start/stop/min_points/window/min_periods node.
+    output: list with a result dict per parameter set
+    """
+    hits = {}
+    for dataset in datasets:
+        for counts, truth in dataset.days:
+            labels = filter_short_sessions(
+                label_sessions(counts, start, stop), min_points)
+            change = rolling_changes(counts, labels, window, min_periods)
+            # thresholds that split the same sessions give the same labels
+            scores = {}
+            for threshold, limit in itertools.product(change_thresholds,
+                                                      max_splits):
+                split = filter_short_sessions(split_sessions_on_changes(
+                    counts, labels, window, min_periods, threshold, limit,
+                    change), min_points)
+                key = split.tobytes()
+                if key not in scores:
+                    scores[key] = score(truth, *session_predictions(
+                        counts, split), grouped_cutoffs)
+                exact, occupied, grouped = scores[key]
+                for cutoff, grouped_hits in zip(grouped_cutoffs, grouped):
+                    total = hits.setdefault((threshold, limit, cutoff),
+                                            {'exact': {}, 'occupied': 0,
+                                             'grouped': 0})
+                    total['exact'][dataset.name] = total['exact'].get(
+                        dataset.name, 0) + exact
+                    total['occupied'] += occupied
+                    total['grouped'] += grouped_hits
+
+    rows = sum(dataset.rows for dataset in datasets)
+    exact_rows = sum(dataset.exact_rows for dataset in datasets)
+    results = []
+    for (threshold, limit, cutoff), total in hits.items():
+        result = dict(start=start, stop=stop, min_points=min_points,
+                      window=window, min_periods=min_periods,
+                      change_threshold=threshold, max_splits=limit,
+                      grouped_cutoff=cutoff)
+        result['Exact_Accuracy'] = sum(total['exact'].values()) / exact_rows
+        result['Occupied_Accuracy'] = total['occupied'] / rows
+        result['Grouped_Accuracy'] = total['grouped'] / rows
+        for dataset in datasets:
+            result[f'Accuracy_{dataset.name}'] = total['exact'].get(
+                dataset.name, 0) / dataset.exact_rows
+        results.append(result)
+    return results
+
+
+def subtrees(sets):
+    """
+    output: dict (start, stop, min_points, window, min_periods) -> (change
+    thresholds, split limits, grouped cut-offs) of the parameter sets
+    """
+    trees = {}
+    for params in sets:
+        key = tuple(params[param] for param in PARAMS[:5])
+        thresholds, limits, cutoffs = trees.setdefault(key, ([], [], []))
+        if params['change_threshold'] not in thresholds:
+            thresholds.append(params['change_threshold'])
+        if params['max_splits'] not in limits:
+            limits.append(params['max_splits'])
+        if params['grouped_cutoff'] not in cutoffs:
+            cutoffs.append(params['grouped_cutoff'])
+    return trees
+
+
+def run_sweep(grid=None, datasets=None, max_workers=None, pool=None):
+    """
+    input: dict parameter -> values (default_grid() by default), the
+    GroundTruth list (load_all() by default) and the number of processes
+    output: DataFrame with a row per parameter set and its accuracies, the
+    best first; Default marks the current parameters
+    """
+    from parallel import make_pool
+
+    datasets = load_all() if datasets is None else datasets
+    if not datasets:
+        raise ValueError('no ground truth files found')
+    sets = parameter_sets(default_grid() if grid is None else grid)
+    trees = subtrees(sets)
+    keys = list(trees)
+    args = [[datasets] * len(keys)] + [list(column) for column in zip(*keys)]
+    args += [[trees[key][column] for key in keys] for column in range(3)]
+
+    if max_workers == 1:
+        results = map(evaluate_subtree, *args)
+    elif pool is None:
+        with make_pool(max_workers) as own_pool:
+            results = list(own_pool.map(evaluate_subtree, *args))
+    else:
+        results = pool.map(evaluate_subtree, *args)
+
+    wanted = {tuple(params[param] for param in PARAMS) for params in sets}
+    table = pd.DataFrame([result for subtree in results
+                          for result in subtree
+                          if tuple(result[param] for param in PARAMS)
+                          in wanted])
+    current = dict(default_params(), grouped_cutoff=GROUPED_CUTOFF)
+    # no split limit (None) is NaN in the table
+    table['Default'] = np.logical_and.reduce(
+        [table[param].isna() if value is None else table[param] == value
+         for param, value in current.items()])
+    return table.sort_values(['Exact_Accuracy', 'Grouped_Accuracy'],
+                             ascending=False, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    for param in PARAMS:
+        parser.add_argument(f'--{param.replace("_", "-")}', type=float,
+                            nargs='+', help='values to try')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default=None, help='csv with all sets')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    grid = default_grid()
+    for param in PARAMS:
+        values = getattr(args, param)
+        if values is not None:
+            grid[param] = [int(value) if value.is_integer() else value
+                           for value in values]
+    grid['max_splits'] = [limit or None for limit in grid['max_splits']]
+
+    datasets = load_all()
+    table = run_sweep(grid, datasets, max_workers=args.workers)
+    print(f'{len(table)} parameter sets')
+    for dataset in datasets:
+        skipped = dataset.rows - dataset.exact_rows
+        if skipped:
+            print(f'{dataset.name}: {skipped} of {dataset.rows} readings have '
+                  f'more than {MAX_PEOPLE} people, they only count for the '
+                  'occupied and grouped accuracy')
+    print(table.head(args.top).to_string(index=False))
+    print('current parameters:')
+    print(table[table['Default']].to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+The session table of incremental.IncrementalProcessor after a series of
+updates must match a full recompute of the newest export.
+"""
+import os
+import warnings
+
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+
+OLD_EXPORT = os.path.join(ROOT, 'uploads', '2.P02.xlsx')
+NEW_EXPORT = os.path.join(ROOT, 'Data', 'TriggerCounts', 'Alta_sensors',
+                          '2P.02.xlsx')
+
+
+@pytest.fixture(scope='module')
+def exports():
+    from parallel import load_sensor_file
+
+    warnings.filterwarnings('ignore')
+    return load_sensor_file(OLD_EXPORT), load_sensor_file(NEW_EXPORT)
+
+
+def full_recompute(*exports):
+    """
+    output: session table of every day computed from the newest export that
+    has that day
+    """
+    from incremental import session_table
+
+    tables = []
+    done = set()
+    for data in reversed(exports):
+        table = session_table(data)
+        days = set(data['Date'].dt.date)
+        tables.append(table[~table['Date'].isin(done)])
+        done |= days
+    return pd.concat(tables).sort_values('Date', kind='stable',
+                                          ignore_index=True)
+
+
+def check(processor, expected):
+    pd.testing.assert_frame_equal(processor.sessions(), expected,
+                                  check_dtype=False)
+
+
+def test_grown_export(tmp_path, exports):
+    from incremental import IncrementalProcessor
+
+    old, new = exports
+    processor = IncrementalProcessor('2P02', str(tmp_path))
+    processor.update(old)
+    processor.update(new)
+    check(processor, full_recompute(old, new))
+
+    # the state on disk gives the same result, nothing changes again
+    processor = IncrementalProcessor('2P02', str(tmp_path))
+    assert processor.update(new).empty
+    check(processor, full_recompute(old, new))
+
+
+def test_revised_reading(tmp_path, exports):
+    from incremental import IncrementalProcessor
+
+    old, new = exports
+    processor = IncrementalProcessor('2P02', str(tmp_path))
+    processor.update(old)
+
+    # a count of a timestamp that was processed already is revised
+    revised = new.copy()
+    index = revised.index[revised['Date'].isin(old['Date'])][100]
+    revised.loc[index, 'Count'] += 40
+    processor.update(revised)
+    assert revised.loc[index, 'Date'].date() in processor.updated_days
+    check(processor, full_recompute(old, revised))
+
+
+def test_growing_and_partial_exports(tmp_path, exports):
+    from incremental import IncrementalProcessor
+
+    _, new = exports
+    new = new.sort_values('Date', kind='stable', ignore_index=True)
+    processor = IncrementalProcessor('2P02', str(tmp_path))
+    # cumulative exports, cut in the middle of a day
+    for end in (1000, 2500, 2501, 4000):
+        processor.update(new.iloc[:end])
+        check(processor, full_recompute(new.iloc[:end]))
+    # exports with only the rows after the previous one
+    for start, end in ((4000, 6000), (6000, 9000), (9000, len(new))):
+        processor = IncrementalProcessor('2P02', str(tmp_path))
+        processor.update(new.iloc[start:end])
+        check(processor, full_recompute(new.iloc[:end]))
@@ -0,0 +1,47 @@
+"""
+live.LiveDetector must find the sessions of segmentation.segment_sessions
+when the readings are fed one at a time.
+"""
+import glob
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+
+FILES = sorted(glob.glob(os.path.join(ROOT, 'uploads', '*.xlsx')))
+
+
+def offline_sessions(data):
+    """
+    output: sorted (start, end, number of readings) of the sessions of every
+    day, without a split limit
+    """
+    from segmentation import segment_sessions
+
+    sessions = []
+    data = data.sort_values('Date', kind='stable')
+    for _, day_data in data.groupby(data['Date'].dt.normalize()):
+        labels = segment_sessions(day_data['Count'].to_numpy(),
+                                  max_splits=None)
+        dates = day_data['Date'].to_numpy()
+        for label in np.unique(labels[labels != 0]):
+            rows = np.flatnonzero(labels == label)
+            sessions.append((dates[rows[0]], dates[rows[-1]], len(rows)))
+    return sorted(sessions)
+
+
+@pytest.mark.parametrize('file_path', FILES,
+                         ids=[os.path.relpath(path, ROOT) for path in FILES])
+def test_close_events_match_segment_sessions(file_path):
+    from live import LiveDetector, replay
+    from parallel import load_sensor_file
+
+    warnings.filterwarnings('ignore')
+    events = replay([file_path], LiveDetector(max_splits=None))
+    closed = sorted((np.datetime64(event['start'], 'ns'),
+                     np.datetime64(event['end'], 'ns'), event['num_points'])
+                    for event in events if event['type'] == 'close')
+    assert closed == offline_sessions(load_sensor_file(file_path))
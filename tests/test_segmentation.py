@@ -0,0 +1,202 @@
+"""
+Regression test of segmentation.segment_sessions and
+model.calculate_session_stats against the loops that
+predict_occupancy_session used before they were vectorized, on every day of
+the exports in uploads/ and Data_clean/, and of the repeated splits against
+a loop that splits one session at a time.
+"""
+import glob
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+
+FILES = sorted(glob.glob(os.path.join(ROOT, 'uploads', '*.xlsx')) +
+               glob.glob(os.path.join(ROOT, 'Data_clean', '*_sensors',
+                                      '*.xlsx')))
+
+
+def old_session_labels(data):
+    """
+    input: Date/Count rows of one day, sorted on Date
+    output: the Session column of the old start/stop loop, short session
+    filter and single split on the rolling average
+    """
+    data = data.copy()
+    session_id = 0
+    in_session = False
+    session_labels = []
+    for i in range(len(data)):
+        if data['Count'].iloc[i] > 0 and not in_session:
+            in_session = True
+            session_id += 1
+        if in_session:
+            session_labels.append(session_id)
+        else:
+            session_labels.append(0)
+        if in_session and data['Count'].iloc[i] < 5:
+            in_session = False
+    data['Session'] = session_labels
+
+    session_counts = data['Session'].value_counts()
+    valid_sessions = session_counts[session_counts >= 6].index
+    data.loc[~data['Session'].isin(valid_sessions), 'Session'] = 0
+
+    new_session_id = max(data['Session']) + 1
+    for session in data['Session'].unique():
+        if session == 0:
+            continue
+        session_data = data[data['Session'] == session]
+        rolling_avg = session_data['Count'].rolling(window=25,
+                                                    min_periods=20).mean()
+        prev_avg = rolling_avg.iloc[0]
+        for i in range(1, len(session_data)):
+            current_avg = rolling_avg.iloc[i]
+            if abs(current_avg - prev_avg) > 10:
+                data.loc[session_data.index[i:], 'Session'] = new_session_id
+                new_session_id += 1
+                break
+            prev_avg = current_avg
+
+    session_counts = data['Session'].value_counts()
+    valid_sessions = session_counts[session_counts >= 6].index
+    data.loc[~data['Session'].isin(valid_sessions), 'Session'] = 0
+    return data['Session'].to_numpy()
+
+
+def old_session_stats(data):
+    """
+    input: Date/Count rows of one day with the old Session column
+    output: DataFrame with the stats of the old calculate_session_stats
+    """
+    from model import find_nearest_occupancy, people_class
+
+    stats = []
+    for index, session in enumerate(data['Session'].unique()):
+        if session == 0:
+            continue
+        counts = data.loc[data['Session'] == session, 'Count']
+        q1, q3 = counts.quantile(0.25), counts.quantile(0.75)
+        iqr = q3 - q1
+        avg_count = counts[(counts >= q1 - 1.5 * iqr) &
+                           (counts <= q3 + 1.5 * iqr)].mean()
+        stats.append({
+            'Session': index,
+            'Total': counts.sum(),
+            'Mean': counts.mean(),
+            'Std': counts.std(),
+            'Num_Points': len(counts),
+            'People': people_class(find_nearest_occupancy(avg_count)),
+        })
+    return pd.DataFrame(stats, columns=['Session', 'Total', 'Mean', 'Std',
+                                        'Num_Points', 'People'])
+
+
+def sensor_days(file_path):
+    from parallel import load_sensor_file
+
+    try:
+        data = load_sensor_file(file_path)
+    except ValueError:
+        # coupe1_combined.xlsx has no header
+        pytest.skip('no Date/Count header')
+    data = data.sort_values('Date')
+    return [day_data for _, day_data
+            in data.groupby(data['Date'].dt.normalize())]
+
+
+@pytest.mark.parametrize('file_path', FILES,
+                         ids=[os.path.relpath(path, ROOT) for path in FILES])
+def test_single_split_matches_old_loop(file_path):
+    from model import (calculate_session_stats, find_nearest_occupancies,
+                       segmented_stats_table)
+    from segmentation import segment_sessions
+
+    warnings.filterwarnings('ignore')
+    for day_data in sensor_days(file_path):
+        expected = old_session_labels(day_data)
+        labels = segment_sessions(day_data['Count'].to_numpy(), max_splits=1)
+        np.testing.assert_array_equal(labels, expected)
+
+        day_data = day_data.assign(Session=labels)
+        session_avgs = segmented_stats_table(day_data)['IQR_Mean']
+        session_people = dict(zip(session_avgs.index,
+                                  find_nearest_occupancies(session_avgs)))
+        stats = pd.DataFrame(calculate_session_stats(
+            day_data, session_avgs, session_people))
+        expected_stats = old_session_stats(day_data)
+        # a day without sessions has no columns at all
+        pd.testing.assert_frame_equal(
+            stats.reindex(columns=expected_stats.columns),
+            expected_stats, check_dtype=False, check_index_type=False)
+
+
+def reference_split_labels(counts, labels, window, min_periods,
+                           change_threshold, max_splits):
+    """
+    input: counts and filtered session labels
+    output: labels split by applying the rolling rule again after every
+    split, one session and one split at a time
+    """
+    labels = labels.copy()
+    new_session_id = labels.max(initial=0) + 1
+    for session in [label for label in pd.unique(labels) if label != 0]:
+        rows = np.flatnonzero(labels == session)
+        start = 0
+        splits = 0
+        while max_splits is None or splits < max_splits:
+            rolling_avg = pd.Series(counts[rows[start:]]).rolling(
+                window, min_periods=min_periods).mean().to_numpy()
+            with np.errstate(invalid='ignore'):
+                jumps = np.flatnonzero(
+                    np.abs(np.diff(rolling_avg)) > change_threshold)
+            if len(jumps) == 0:
+                break
+            start += jumps[0] + 1
+            labels[rows[start:]] = new_session_id
+            new_session_id += 1
+            splits += 1
+    return labels
+
+
+def renumbered(labels):
+    """
+    output: the labels numbered 1, 2, ... in order of appearance, so labels
+    that only differ in their ids are equal
+    """
+    ids = {}
+    return np.array([0 if label == 0 else ids.setdefault(label, len(ids) + 1)
+                     for label in labels], dtype=np.int64)
+
+
+@pytest.mark.parametrize('max_splits', [None, 2])
+def test_splits_match_reference(max_splits):
+    from segmentation import (filter_short_sessions, label_sessions,
+                              segment_sessions)
+
+    rng = np.random.default_rng(25)
+    for _ in range(1000):
+        levels = rng.choice([0, 3, 60, 120, 220, 250],
+                            size=rng.integers(1, 8))
+        counts = np.repeat(levels, rng.integers(1, 80, size=len(levels)))
+        counts = np.clip(counts + rng.normal(0, 8, len(counts)).round(), 0,
+                         None)[:rng.integers(0, 400)]
+        counts[rng.random(len(counts)) < 0.05] = np.nan
+        window = int(rng.integers(3, 30))
+        min_periods = int(rng.integers(1, window + 1))
+        change_threshold = float(rng.choice([2, 5, 10, 20]))
+
+        labels = filter_short_sessions(label_sessions(counts))
+        expected = filter_short_sessions(reference_split_labels(
+            counts, labels, window, min_periods, change_threshold,
+            max_splits))
+        result = segment_sessions(counts, window=window,
+                                  min_periods=min_periods,
+                                  change_threshold=change_threshold,
+                                  max_splits=max_splits)
+        np.testing.assert_array_equal(renumbered(result),
+                                      renumbered(expected))
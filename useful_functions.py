@@ -33,7 +33,8 @@ def import_file(sensor_type, sensor_number):
             f"Voor sensor_number, kijk naar hoe de file heet en gebruik daarvan dus de eerste 4 karakters'\n"
             f"Examples: 'Data_clean/Locus_sensors/B.253_processed.xlsx', 'Data_clean/Alta_sensors/B.254_processed.xlsx'"
         )
-    file = pd.read_excel(file_path)
+    from file_cache import read_excel_cached
+    file = read_excel_cached(file_path)
     file.dropna(subset=['Count'], inplace=True)
     return file
 
@@ -107,8 +108,8 @@ def peaks_for_specific_timeframe(data, start_time, end_time):
     """
 
     import matplotlib.pyplot as plt
-    mask = (data['Date'] >= start_time) & (data['Date'] <= end_time)
-    filtered_data = data.loc[mask]
+    from sensor_store import as_frame, time_window
+    filtered_data = as_frame(time_window(data, start_time, end_time, closed='both'))
 
     plt.figure(figsize=(10, 6))
     plt.plot(filtered_data['Date'], filtered_data['Count'], marker='o')
@@ -160,10 +161,11 @@ def show_valid_peaks(data, day, threshold, consecutive_points, offset=0):
 
 
 def make_sessions(data, day, threshold, consecutive_points, offset=0):
-    mask = data['Date'].dt.strftime('%Y-%m-%d') == day
-    filtered_data = data.loc[mask].reset_index(drop=True)
+    from segmentation import find_low_count_peaks
+    from sensor_store import as_frame, day_window
+    filtered_data = as_frame(day_window(data, day)).reset_index(drop=True)
 
-    valid_peaks = [index for index in range(len(filtered_data['Count'])) if surrounded_by_low_counts(index, filtered_data['Count'], threshold, consecutive_points) and filtered_data['Count'][index] > threshold + offset]
+    valid_peaks = find_low_count_peaks(filtered_data['Count'].to_numpy(), threshold, consecutive_points, offset).tolist()
     filtered_data['Session'] = (filtered_data.index.isin(valid_peaks)).cumsum()
     # # Drop rows where the 'Count' is below the threshold
     # filtered_data = filtered_data[filtered_data['Count'] > threshold].reset_index(drop=True)